@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+# Check that the make stub of benchmarks/shims understands the batched
+# wrappers written by lib/common.py: all environments of a Makefile.builder
+# must be evaluated by a single stub invocation, with the same values as
+# the Python evaluation. Run it after changing either of them:
+#
+#   ./benchmarks/check_shims.py
+
+import os
+import sys
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import lib.common  # noqa
+from lib.component import BUILDER_VARIABLES  # noqa
+from fixtures import MAKEFILE_BUILDER, RELEASES  # noqa
+
+SHIMS_DIR = os.path.join(BENCHMARKS_DIR, 'shims')
+
+# make replacement recording its invocations before running the stub
+COUNTING_MAKE = """#!/bin/sh
+echo >> {calls}
+exec {make} "$@"
+"""
+
+
+def get_envs(component_path):
+    envs = []
+    for dists in RELEASES.values():
+        for dist in dists["dom0"]:
+            envs.append(lib.common.get_rpm_env(component_path, dist, 'dom0'))
+        for dist in dists["vm"]:
+            if dist.startswith('fc') or dist.startswith('centos'):
+                envs.append(lib.common.get_rpm_env(component_path, dist, 'vm'))
+            else:
+                envs.append(lib.common.get_deb_env(component_path, dist))
+    return envs
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        component_path = os.path.join(tmpdir, 'qubes-src', 'check-shims')
+        os.makedirs(component_path)
+        makefile = os.path.join(component_path, 'Makefile.builder')
+        with open(makefile, 'w') as fd:
+            fd.write(MAKEFILE_BUILDER.format(
+                dom0_specs='rpm_spec/check-shims-dom0.spec',
+                vm_specs='rpm_spec/check-shims-vm.spec',
+                debian_dirs='debian'))
+
+        calls = os.path.join(tmpdir, 'calls')
+        make = os.path.join(tmpdir, 'make')
+        with open(make, 'w') as fd:
+            fd.write(COUNTING_MAKE.format(
+                calls=calls, make=os.path.join(SHIMS_DIR, 'make')))
+        os.chmod(make, 0o755)
+        lib.common.MAKE = make
+
+        envs = get_envs(component_path)
+        values = lib.common.make_makefile_values(
+            makefile, BUILDER_VARIABLES, envs,
+            os.path.dirname(component_path))
+        expected = [lib.common.evaluate_makefile_values(
+            makefile, BUILDER_VARIABLES, env) for env in envs]
+        with open(calls) as fd:
+            calls_count = len(fd.readlines())
+
+    failed = False
+    if calls_count != 1:
+        print("FAIL: %d make invocations for %d environments, expected 1" % (
+            calls_count, len(envs)))
+        failed = True
+    for env, value, expected_value in zip(envs, values, expected):
+        if value != expected_value:
+            print("FAIL: %s %s: %s != %s" % (
+                env["PACKAGE_SET"], env["DIST"], value, expected_value))
+            failed = True
+    if failed:
+        return 1
+    print("OK: %d environments evaluated by one make invocation" % len(envs))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
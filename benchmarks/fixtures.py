@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+
+# Synthetic qubes-src: N fake components git repositories with a master and
+# a release4.0 branch, in the layout expected by lib/common.py and the
+# parsers, along with release.json and components/*.json.
+#
+#   ./benchmarks/fixtures.py --count 1000 /tmp/qubes-bench
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+RELEASES = {
+    "4.0": {
+        "dom0": ["fc25"],
+        "vm": ["fc32", "centos7", "buster"]
+    },
+    "4.1": {
+        "devel": 1,
+        "dom0": ["fc32"],
+        "vm": ["fc32", "fc33", "bullseye"]
+    }
+}
+
+BRANCHES = {
+    "4.0": "release4.0",
+    "4.1": "master"
+}
+
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "Benchmark",
+    "GIT_AUTHOR_EMAIL": "benchmark@localhost",
+    "GIT_COMMITTER_NAME": "Benchmark",
+    "GIT_COMMITTER_EMAIL": "benchmark@localhost",
+    "GIT_AUTHOR_DATE": "2020-01-01T00:00:00+0000",
+    "GIT_COMMITTER_DATE": "2020-01-01T00:00:00+0000",
+}
+
+MAKEFILE_BUILDER = """\
+ifeq ($(PACKAGE_SET),dom0)
+RPM_SPEC_FILES := {dom0_specs}
+else ifeq ($(PACKAGE_SET),vm)
+ifneq ($(filter $(DISTRIBUTION), fedora centos),)
+RPM_SPEC_FILES := {vm_specs}
+endif
+ifeq ($(DISTRIBUTION),debian)
+DEBIAN_BUILD_DIRS := {debian_dirs}
+endif
+endif
+"""
+
+SPEC_IN = """\
+Name:		{name}
+Version:	@VERSION@
+Release:	@REL@%{{?dist}}
+Summary:	{name} benchmark package
+License:	GPL
+BuildArch:	noarch
+
+%description
+{name} benchmark package
+
+%package devel
+Summary:	{name} development files
+
+%description devel
+{name} development files
+
+%files
+
+%files devel
+
+%changelog
+@CHANGELOG@
+"""
+
+SPEC = """\
+%global debug_package %{{nil}}
+
+Name:		{name}
+Version:	{version}
+Release:	{release}%{{?dist}}
+Summary:	{name} benchmark package
+License:	GPL
+
+%description
+{name} benchmark package
+
+%if 0%{{?fedora}}
+%package fedora
+Summary:	{name} Fedora only files
+
+%description fedora
+{name} Fedora only files
+
+%files fedora
+%endif
+
+%package -n python3-{name}
+Summary:	{name} Python module
+BuildArch:	noarch
+
+%description -n python3-{name}
+{name} Python module
+
+%files
+
+%files -n python3-{name}
+"""
+
+DEBIAN_CONTROL = """\
+Source: {name}
+Section: admin
+Priority: optional
+Maintainer: Benchmark <benchmark@localhost>
+Build-Depends: debhelper (>= 9)
+Standards-Version: 4.1.3
+
+Package: {name}
+Architecture: any
+Depends: ${{shlibs:Depends}}, ${{misc:Depends}}
+Description: {name} benchmark package
+
+Package: {name}-doc
+Architecture: all
+Description: {name} documentation
+"""
+
+DEBIAN_CHANGELOG = """\
+{name} ({version}-{release}) unstable; urgency=medium
+
+  * Benchmark release
+
+ -- Benchmark <benchmark@localhost>  Wed, 01 Jan 2020 00:00:00 +0000
+"""
+
+
+def get_component_name(idx):
+    return "bench-component-%05d" % idx
+
+
+def get_component_files(name, idx):
+    # components alternate between the layouts found in qubes-src:
+    # rpm and deb, plain spec, deb only and dom0 only
+    version = "%d.%d.%d" % (4, idx % 10, idx % 7)
+    release = "1"
+    kind = idx % 4
+    files = {}
+    dom0_specs = []
+    vm_specs = []
+    debian_dirs = []
+    if kind in (0, 1):
+        files["version"] = version + "\n"
+        files["rel"] = release + "\n"
+    if kind == 0:
+        for package_set, specs in (("dom0", dom0_specs), ("vm", vm_specs)):
+            spec = "rpm_spec/%s-%s.spec" % (name, package_set)
+            files[spec + ".in"] = SPEC_IN.format(
+                name="%s-%s" % (name, package_set))
+            specs.append(spec)
+    elif kind in (1, 3):
+        spec = "rpm_spec/%s.spec" % name
+        files[spec] = SPEC.format(name=name, version=version, release=release)
+        dom0_specs.append(spec)
+        if kind == 1:
+            vm_specs.append(spec)
+    if kind in (0, 1, 2):
+        files["debian/control"] = DEBIAN_CONTROL.format(name=name)
+        files["debian/changelog"] = DEBIAN_CHANGELOG.format(
+            name=name, version=version, release=release)
+        debian_dirs.append("debian")
+    files["Makefile.builder"] = MAKEFILE_BUILDER.format(
+        dom0_specs=' '.join(dom0_specs), vm_specs=' '.join(vm_specs),
+        debian_dirs=' '.join(debian_dirs))
+    return files
+
+
+def git(cwd, *args):
+    env = dict(os.environ, **GIT_ENV)
+    subprocess.check_call(["git"] + list(args), cwd=cwd, env=env,
+                          stdout=subprocess.DEVNULL)
+
+
+def create_component(qubes_src, name, idx):
+    component_path = os.path.join(qubes_src, name)
+    files = get_component_files(name, idx)
+    for filename, content in files.items():
+        path = os.path.join(component_path, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fd:
+            fd.write(content)
+    git(component_path, "-c", "init.defaultBranch=master", "init", "-q")
+    git(component_path, "add", "-A")
+    git(component_path, "commit", "-q", "-m", "Initial commit")
+    git(component_path, "branch", "release4.0")
+
+
+def create_fixtures(path, count):
+    qubes_src = os.path.join(path, "qubes-src")
+    components_folder = os.path.join(path, "components")
+    os.makedirs(qubes_src, exist_ok=True)
+    os.makedirs(components_folder, exist_ok=True)
+
+    components = []
+    for idx in range(count):
+        name = get_component_name(idx)
+        components.append(name)
+        if not os.path.exists(os.path.join(qubes_src, name, '.git')):
+            create_component(qubes_src, name, idx)
+        content = {
+            name: {
+                "releases": {
+                    release: {
+                        "branch": BRANCHES[release],
+                        "dom0": {},
+                        "vm": {}
+                    } for release in RELEASES
+                }
+            }
+        }
+        with open(os.path.join(components_folder, '%s.json' % name),
+                  'w') as fd:
+            fd.write(json.dumps(content, indent=4))
+
+    with open(os.path.join(path, "release.json"), 'w') as fd:
+        fd.write(json.dumps({
+            "releases": RELEASES,
+            "components": components
+        }, indent=4))
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "path",
+        help="Destination folder. Existing components repositories are kept."
+    )
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=100,
+        help="Number of components."
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    create_fixtures(args.path, args.count)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
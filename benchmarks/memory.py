@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+# Memory held by loaded components, comparing plain JSON structures (the
+# previous in-memory representation: packages lists and NVR strings as read
+# from components files and states) with QubesComponent objects:
+#
+#   ./benchmarks/memory.py --sizes 1000 5000 --packages 8
+#
+# Components records are synthetic and built in memory, no qubes-src is
+# needed.
+
+import os
+import gc
+import sys
+import json
+import argparse
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+from lib.component import QubesComponent  # noqa
+from lib.dist import QubesDist  # noqa
+from fixtures import RELEASES, BRANCHES  # noqa
+
+PACKAGES_SUFFIXES = ['', '-devel', '-libs', '-doc', '-tests', '-debuginfo',
+                     '-debugsource', '-common', '-utils', '-data']
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs='+',
+        default=[1000, 5000],
+        help="Numbers of components to load."
+    )
+    parser.add_argument(
+        "--packages",
+        type=int,
+        default=6,
+        choices=range(1, len(PACKAGES_SUFFIXES) + 1),
+        metavar="N",
+        help="Number of packages per component and dist (1 to %d)." % len(
+            PACKAGES_SUFFIXES)
+    )
+    return parser.parse_args()
+
+
+def get_records(idx, packages_count):
+    # components file and state contents of a component, the state having
+    # NVRs both as tuples and as built files names
+    name = "bench-component-%05d" % idx
+    packages = [name + suffix
+                for suffix in PACKAGES_SUFFIXES[:packages_count]]
+    version, release = "4.1.%d" % (idx % 30), str(idx % 5 + 1)
+    releases = {}
+    states = {}
+    nvr_states = {}
+    for qubes_release, dists in RELEASES.items():
+        releases[qubes_release] = {"branch": BRANCHES[qubes_release]}
+        state = {
+            "branch": BRANCHES[qubes_release],
+            "commit": "%040x" % idx,
+            "dists": {"dom0": dists["dom0"], "vm": dists["vm"]},
+            "nvr": {"dom0": {}, "vm": {}}
+        }
+        nvr_state = json.loads(json.dumps(state))
+        for package_set in ("dom0", "vm"):
+            releases[qubes_release][package_set] = {}
+            for dist_name in dists[package_set]:
+                dist = QubesDist(dist_name)
+                if dist.is_rpm():
+                    nvrs = [(pkg, version, "%s%s" % (
+                        release, dist.get_rpm_macros()["dist"]), "noarch")
+                        for pkg in packages]
+                    files = [QubesComponent.get_nvr_rpm(*nvr)
+                             for nvr in nvrs]
+                else:
+                    nvrs = [(pkg, version, release, "amd64")
+                            for pkg in packages]
+                    files = [QubesComponent.get_nvr_deb(dist, *nvr)
+                             for nvr in nvrs]
+                releases[qubes_release][package_set][dist_name] = packages
+                state["nvr"][package_set][dist_name] = nvrs
+                nvr_state["nvr"][package_set][dist_name] = files
+        states[qubes_release] = state
+        nvr_states[qubes_release] = nvr_state
+    return name, json.dumps({"releases": releases}), \
+        json.dumps({"releases": states}), \
+        json.dumps({"releases": nvr_states})
+
+
+def load_plain(records):
+    return [(json.loads(component), json.loads(nvr_state))
+            for _, component, _, nvr_state in records]
+
+
+def load_components(records):
+    components = []
+    for name, component, state, _ in records:
+        qubes_component = QubesComponent(
+            name=name, orig_src=os.path.join('qubes-src', name),
+            **json.loads(component))
+        qubes_component.load_state(json.loads(state))
+        components.append(qubes_component)
+    return components
+
+
+def measure(func, *args):
+    gc.collect()
+    tracemalloc.start()
+    loaded = func(*args)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del loaded
+    return size
+
+
+def main():
+    args = get_args()
+    print("%-12s%16s%16s%12s" % ("components", "plain (MiB)",
+                                 "compact (MiB)", "reduction"))
+    for size in args.sizes:
+        records = [get_records(idx, args.packages) for idx in range(size)]
+        plain = measure(load_plain, records)
+        compact = measure(load_components, records)
+        print("%-12d%16.1f%16.1f%11.1f%%" % (
+            size, plain / 1024 / 1024, compact / 1024 / 1024,
+            100 * (1 - compact / plain)))
+
+
+if __name__ == '__main__':
+    main()
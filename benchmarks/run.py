@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+# Timings of the main ComponentsManagerCli operations on synthetic qubes-src
+# trees (see fixtures.py) of increasing size:
+#
+#   ./benchmarks/run.py --sizes 100 1000 10000 --workdir /tmp/qubes-bench
+#
+# Fixtures are kept in the work folder and reused by next runs. With --shims,
+# make and rpmspec are replaced by the stubs of benchmarks/shims so that
+# benchmarks run on hosts without them.
+
+import os
+import sys
+import time
+import runpy
+import shutil
+import argparse
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import lib.common  # noqa
+import lib.rpm_parser  # noqa
+from fixtures import create_fixtures  # noqa
+
+MANAGER = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'components-manager.py')
+SHIMS_DIR = os.path.join(BENCHMARKS_DIR, 'shims')
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs='+',
+        default=[100, 1000, 10000],
+        help="Numbers of components to benchmark."
+    )
+    parser.add_argument(
+        "--workdir",
+        default=os.path.join(tempfile.gettempdir(), 'qubes-bench'),
+        help="Folder holding fixtures, one subfolder per size."
+    )
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=1,
+        help="Number of components to update concurrently."
+    )
+    parser.add_argument(
+        "--makefile-backend",
+        choices=["auto", "make"],
+        default="auto"
+    )
+    parser.add_argument(
+        "--rpm-backend",
+        choices=["auto", "rpm", "rpmspec"],
+        default="auto"
+    )
+    parser.add_argument(
+        "--shims",
+        action="store_true",
+        help="Use make and rpmspec stubs."
+    )
+    return parser.parse_args()
+
+
+class Timer:
+    def __init__(self):
+        self.timings = []
+
+    def run(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.timings.append((name, time.perf_counter() - start))
+        return result
+
+
+def run_benchmark(cli_class, path, args):
+    cache_dir = os.path.join(path, 'cache')
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    # fixtures may have been updated by a previous run
+    create_fixtures(path, args.size)
+
+    def get_cli():
+        return cli_class(
+            releasefile=os.path.join(path, 'release.json'),
+            components_folder=os.path.join(path, 'components'),
+            qubes_src=os.path.join(path, 'qubes-src'),
+            cache_dir=cache_dir,
+            makefile_backend=args.makefile_backend,
+            rpm_backend=args.rpm_backend)
+
+    timer = Timer()
+    cli = get_cli()
+    timer.run("init", cli.init)
+    timer.run("load components (no index)", cli.load_components, ['all'])
+    timer.run("update (cold cache)", cli.update_components, ['all'],
+              jobs=args.jobs)
+    timer.run("update (warm cache)", cli.update_components, ['all'],
+              jobs=args.jobs)
+    timer.run("update (changed only)", cli.update_components, ['all'],
+              jobs=args.jobs, changed_only=True)
+
+    cli = get_cli()
+    timer.run("init (again)", cli.init)
+    timer.run("load components (index)", cli.load_components, ['all'])
+    timer.run("get", cli.get_components_packages_list, ['all'])
+    timer.run("get with nvr", cli.get_components_packages_list, ['all'],
+              with_nvr=True)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for release in sorted(cli.releases):
+            timer.run("generate %s" % release, cli.generate_conf, release,
+                      os.path.join(tmpdir, 'builder.conf'))
+    return timer.timings
+
+
+def main():
+    args = get_args()
+    if args.shims:
+        lib.common.MAKE = os.path.join(SHIMS_DIR, 'make')
+        lib.rpm_parser.RPMSPEC = os.path.join(SHIMS_DIR, 'rpmspec')
+    cli_class = runpy.run_path(
+        MANAGER, run_name='benchmark')["ComponentsManagerCli"]
+
+    results = {}
+    for size in args.sizes:
+        args.size = size
+        path = os.path.join(args.workdir, str(size))
+        print("Running benchmark with %d components in %s" % (size, path),
+              file=sys.stderr)
+        results[size] = run_benchmark(cli_class, path, args)
+
+    print("%-32s" % "operation" +
+          ''.join("%12s" % ("%d (s)" % size) for size in args.sizes))
+    names = [name for name, _ in results[args.sizes[0]]]
+    for idx, name in enumerate(names):
+        print("%-32s" % name + ''.join(
+            "%12.3f" % results[size][idx][1] for size in args.sizes))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
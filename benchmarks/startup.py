@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+
+# Startup time of components-manager.py commands which do not need
+# components sources. Run it against a checkout of qubes-components:
+#
+#   ./benchmarks/startup.py --releasefile release.json \
+#       --components-folder components --qubes-src ~/qubes-builder/qubes-src
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+MANAGER = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'components-manager.py')
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--releasefile", default="release.json")
+    parser.add_argument("--components-folder", default="components")
+    parser.add_argument("--qubes-src", default="qubes-src")
+    parser.add_argument(
+        "--component",
+        help="Component used for single component queries (default: first "
+             "one of the release file)."
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=20,
+        help="Number of runs of every command."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Run commands with --no-cache."
+    )
+    return parser.parse_args()
+
+
+def get_commands(component, tmpdir):
+    return [
+        ("import", [sys.executable, "-c", "import runpy; runpy.run_path("
+                    "'%s', run_name='bench')" % MANAGER]),
+        ("get one", ["get", "--packages-list", component]),
+        ("get one with nvr", ["get", "--packages-list", component,
+                              "--with-nvr"]),
+        ("get all", ["get", "--packages-list", "all"]),
+        ("which", ["which", component]),
+        ("generate skeleton", ["generate", "--component-skeleton",
+                               "benchmark-skeleton"]),
+        ("generate builder conf", [
+            "generate", "--builder-conf",
+            os.path.join(tmpdir, "builder.conf")]),
+    ]
+
+
+def main():
+    args = get_args()
+    with open(args.releasefile) as fd:
+        component = args.component or json.loads(fd.read())["components"][0]
+
+    print("%-24s %10s %10s %10s" % ("command", "min (ms)", "median", "max"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # commands like generate --component-skeleton write in the
+        # components folder: they are run against a copy of it
+        components_folder = os.path.join(tmpdir, "components")
+        shutil.copytree(args.components_folder, components_folder)
+        global_args = [
+            "--releasefile", os.path.abspath(args.releasefile),
+            "--components-folder", components_folder,
+            "--qubes-src", os.path.abspath(args.qubes_src),
+        ]
+        if args.no_cache:
+            global_args.append("--no-cache")
+        for name, cmd in get_commands(component, tmpdir):
+            if cmd[0] != sys.executable:
+                cmd = [sys.executable, MANAGER] + global_args + cmd
+            timings = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+                timings.append((time.perf_counter() - start) * 1000)
+            print("%-24s %10.1f %10.1f %10.1f" % (
+                name, min(timings), statistics.median(timings), max(timings)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
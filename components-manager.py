@@ -3,13 +3,26 @@
 import os
 import sys
 import json
+import signal
 import argparse
+import subprocess
+import io
 import logging
+import contextlib
+import concurrent.futures
 
-from jinja2 import Template
-
+from lib import trace
+from lib.common import get_current_branch, get_commit, get_changed_files, \
+    is_ancestor, read_file, write_file, update_file
 from lib.component import QubesComponent
 from lib.dist import QubesDist
+from lib.worktree import QubesWorktreePool
+from lib.cache import QubesParseCache, QubesRunMemo
+from lib.index import QubesComponentsIndex, QubesReverseIndex, get_stamp
+from lib.registry import QubesComponentsRegistry
+from lib.daemon import QubesDaemon, QubesDaemonException, send_request
+from lib.watcher import QubesSourcesWatcher
+from lib.graph import get_build_waves
 
 logger = logging.getLogger(__name__)
 console_handler = logging.StreamHandler(sys.stderr)
@@ -17,6 +30,23 @@ logger.addHandler(console_handler)
 
 AVAILABLE_FORMAT_ITEMS = [
     "component", "qubes_release", "package_set", "dist", "packages"]
+WHICH_FORMAT_ITEMS = [
+    "name", "component", "qubes_release", "package_set", "dist"]
+
+TEMPLATES_DIR = os.path.dirname(os.path.abspath(__file__))
+BUILDER_CONF_TEMPLATE = 'template.conf.jinja'
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME',
+                   os.path.join(os.path.expanduser('~'), '.cache')),
+    'qubes-components-manager')
+
+DEFAULT_SOCKET = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR', DEFAULT_CACHE_DIR),
+    'qubes-components-manager.sock')
+
+# commands the daemon answers
+DAEMON_COMMANDS = ('get', 'which', 'generate', 'build-waves')
 
 
 class QubesComponentsManagerException(Exception):
@@ -24,16 +54,32 @@ class QubesComponentsManagerException(Exception):
 
 
 class ComponentsManagerCli:
-    def __init__(self, releasefile, components_folder, qubes_src, verbose=False):
+    def __init__(self, releasefile, components_folder, qubes_src, verbose=False,
+                 worktrees_dir=None, cache_dir=None,
+                 cache_size=256 * 1024 * 1024, makefile_backend='auto',
+                 rpm_backend='auto'):
         self.releasefile = releasefile
         self.components_folder = components_folder
         self.qubes_src = qubes_src
+        self.worktrees = None
+        if worktrees_dir:
+            self.worktrees = QubesWorktreePool(worktrees_dir)
+        self.makefile_backend = makefile_backend
+        self.rpm_backend = rpm_backend
+        self.cache_dir = cache_dir
+        self.cache = None
+        if cache_dir:
+            self.cache = QubesParseCache(
+                os.path.join(cache_dir, 'parse'), max_size=cache_size)
 
         self.data = {}
         self.releases = {}
         self.dom0 = {}
         self.vm = {}
-        self.components = []
+        self.registry = QubesComponentsRegistry()
+        self.reverse_index = None
+        self.template = None
+        self.stamps = {}
 
         self.verbose = verbose
 
@@ -42,8 +88,7 @@ class ComponentsManagerCli:
         with open(self.releasefile) as fd:
             self.data = json.loads(fd.read())
 
-        self.data["components_list"] = self.data["components"]
-        self.data["components"] = {}
+        self.data["components_list"] = self.data.pop("components")
         self.releases = self.data["releases"].keys()
 
         for rel_key, rel_val in self.data["releases"].items():
@@ -57,26 +102,166 @@ class ComponentsManagerCli:
             for dist in rel_val["vm"]:
                 self.vm[rel_key].append(QubesDist(dist))
 
+    def load_components(self, components=None, need_sources=True):
+        # components files are read only for the components a command
+        # works on, all of them coming from the index if any
+        if not components or 'all' in components:
+            names = self.data["components_list"]
+        else:
+            names = [name for name in self.data["components_list"]
+                     if name in components]
+
+        inputs = None
+        index = None
+        if self.cache_dir and names is self.data["components_list"]:
+            index = QubesComponentsIndex(self.get_index_file())
+            inputs = index.load()
+            if inputs is not None and inputs["names"] != names:
+                inputs = None
+        if inputs is None:
+            inputs = self.read_inputs(names, index, check_sources=(
+                need_sources or index is not None))
+            if index:
+                index.save(inputs)
+        else:
+            logger.debug("DEBUG: Using components index")
+
         # qubes components
+        for component in names:
+            if self.registry.get(component):
+                continue
+            if need_sources and component in inputs["missing_src"]:
+                logger.error("ERROR: Cannot find source for %s" % component)
+                continue
+            if component not in inputs["components"]:
+                continue
+            component_data = inputs["components"][component]
+            qubes_component = QubesComponent(
+                name=component,
+                orig_src=os.path.join(self.qubes_src, component),
+                **component_data)
+            self.registry.add(qubes_component)
+            if component in inputs["states"]:
+                qubes_component.load_state(inputs["states"][component])
+
+    def reload(self):
+        # start again from release file
+        self.data = {}
+        self.dom0 = {}
+        self.vm = {}
+        self.registry = QubesComponentsRegistry()
+        self.reverse_index = None
+        self.init()
+
+    def get_inputs_stamps(self):
+        stamps = {self.releasefile: get_stamp(self.releasefile)}
+        for component in self.data["components_list"]:
+            for path in (os.path.join(self.components_folder,
+                                      '%s.json' % component),
+                         self.get_state_file(component)):
+                stamps[path] = get_stamp(path)
+        return stamps
+
+    def load_component(self, name):
+        # (re)load a single component from its files
+        component_file = os.path.join(
+            self.components_folder, '%s.json' % name)
+        try:
+            with open(component_file) as fd:
+                component_data = json.loads(fd.read()).get(name, {})
+        except FileNotFoundError:
+            self.registry.remove(name)
+            return
+        qubes_component = QubesComponent(
+            name=name,
+            orig_src=os.path.join(self.qubes_src, name),
+            **component_data)
+        try:
+            with open(self.get_state_file(name)) as fd:
+                qubes_component.load_state(json.loads(fd.read()))
+        except FileNotFoundError:
+            pass
+        if self.registry.get(name):
+            self.registry.replace(qubes_component)
+        else:
+            self.registry.add(qubes_component)
+
+    def reload_changed_components(self, stamps):
+        # reload components whose files changed since stamps have been
+        # taken, everything if the release file changed. Returns the new
+        # stamps, to be taken before reading files.
+        new_stamps = self.get_inputs_stamps()
+        if new_stamps[self.releasefile] != stamps.get(self.releasefile):
+            logger.info("INFO: Release file changed, reloading everything")
+            self.reload()
+            new_stamps = self.get_inputs_stamps()
+            self.load_components(['all'], need_sources=False)
+            return new_stamps
+        changed = []
         for component in self.data["components_list"]:
+            for path in (os.path.join(self.components_folder,
+                                      '%s.json' % component),
+                         self.get_state_file(component)):
+                if new_stamps[path] != stamps.get(path):
+                    changed.append(component)
+                    break
+        if any(not self.registry.get(component) for component in changed):
+            # keep release file order for new components
+            self.reload()
+            self.load_components(['all'], need_sources=False)
+            return new_stamps
+        for component in changed:
+            logger.info("INFO: Reloading %s" % component)
+            self.load_component(component)
+        if changed:
+            self.reverse_index = None
+        return new_stamps
+
+    def get_index_file(self):
+        # one index per set of inputs
+        key = QubesParseCache.get_key(
+            os.path.abspath(self.releasefile),
+            os.path.abspath(self.components_folder), self.qubes_src)
+        return os.path.join(self.cache_dir, 'index', '%s.pickle' % key)
+
+    def read_inputs(self, names, index=None, check_sources=True):
+        inputs = {
+            "names": list(names),
+            "components": {},
+            "states": {},
+            "missing_src": []
+        }
+        if index:
+            index.add_input(self.releasefile)
+            # sources being added or removed changes qubes-src mtime
+            index.add_input(self.qubes_src)
+
+        for component in names:
+            if check_sources and \
+                    not os.path.exists(os.path.join(self.qubes_src, component)):
+                inputs["missing_src"].append(component)
+            component_file = os.path.join(
+                self.components_folder, '%s.json' % component)
+            state_file = self.get_state_file(component)
+            if index:
+                index.add_input(component_file)
+                index.add_input(state_file)
             try:
-                component_file = os.path.join(
-                    self.components_folder, '%s.json' % component)
-                orig_src = os.path.join(self.qubes_src, component)
-                if not os.path.exists(orig_src):
-                    logger.error("ERROR: Cannot find source for %s" % component)
-                    continue
                 with open(component_file) as fd:
-                    component_data = json.loads(fd.read()).get(component, {})
-                self.data["components"][component] = component_data
-                kwargs = component_data
-                self.components.append(QubesComponent(
-                    name=component,
-                    orig_src=orig_src,
-                    **kwargs)
-                )
+                    inputs["components"][component] = \
+                        json.loads(fd.read()).get(component, {})
+            except FileNotFoundError:
+                continue
+            try:
+                with open(state_file) as fd:
+                    inputs["states"][component] = json.loads(fd.read())
             except FileNotFoundError:
                 pass
+        return inputs
+
+    def get_state_file(self, name):
+        # local state of components sources, next to components files
+        return os.path.join(self.components_folder, '.state', '%s.json' % name)
 
     def is_devel_version(self, release):
         return self.data["releases"][release].get("devel", 0)
@@ -87,33 +272,22 @@ class ComponentsManagerCli:
     def get_vm(self, release):
         return self.vm[release]
 
+    def get_release_view(self, release):
+        return self.registry.get_release_view(
+            release, self.is_devel_version(release))
+
     def get_branches_conf(self, release):
         branches = []
-        for component in self.components:
-            if release not in component.releases:
-                continue
-            if component.branch[release] != "release%s" % release:
-                if component.branch[release] == "master" and \
-                        self.is_devel_version(release) == 1:
-                    continue
-                branches.append(
-                    'BRANCH_%s = %s' % (component.name.replace('-', '_'),
-                                        component.branch[release]))
+        for component, branch in \
+                self.get_release_view(release).branches.items():
+            branches.append(
+                'BRANCH_%s = %s' % (component.name.replace('-', '_'), branch))
 
         return branches
 
     def get_maintainers_conf(self, release):
-        maintainers = {}
-        for component in self.components:
-            if release not in component.releases:
-                continue
-            for maintainer in component.get_maintainers():
-                if not maintainers.get(maintainer, None):
-                    maintainers[maintainer] = []
-                maintainers[maintainer].append(component.name)
-
         maintainers_conf = []
-        for key, val in maintainers.items():
+        for key, val in self.get_release_view(release).maintainers.items():
             maintainers_conf.append(
                 'ALLOWED_COMPONENTS_%s = %s' % (key, ' '.join(val)))
 
@@ -133,75 +307,177 @@ class ComponentsManagerCli:
 
         return template_aliases
 
-    def generate_conf(self, release, conf_file):
-        builder_plugins = []
-        iso_components = []
-        windows_components = []
-        filtered_components = []
-        for component in self.components:
-            if release not in component.releases:
-                continue
-            if component.is_plugin_type():
-                builder_plugins.append(component)
-            if component.is_iso_component():
-                iso_components.append(component)
-            if component.is_windows_type():
-                windows_components.append(component)
-
-            if component not in builder_plugins + iso_components + \
-                    windows_components:
-                filtered_components.append(component)
+    def get_template(self):
+        # template engine is only needed here
+        from jinja2 import Environment, FileSystemLoader, \
+            FileSystemBytecodeCache
 
-        with open('template.conf.jinja', 'r') as template_fd:
-            template = Template(template_fd.read())
+        if self.template is None:
+            bytecode_cache = None
+            if self.cache_dir:
+                bytecode_cache_dir = os.path.join(self.cache_dir, 'templates')
+                os.makedirs(bytecode_cache_dir, exist_ok=True)
+                bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+            environment = Environment(
+                loader=FileSystemLoader(TEMPLATES_DIR),
+                bytecode_cache=bytecode_cache)
+            self.template = environment.get_template(BUILDER_CONF_TEMPLATE)
+        return self.template
 
+    def get_conf(self, release, build_waves=False):
+        view = self.get_release_view(release)
         conf = {
             "devel": self.is_devel_version(release),
             "release": release,
             "dist_dom0": self.get_dom0(release),
             "dists_vm": self.get_vm(release),
-            "builder_plugins": builder_plugins,
-            "iso_components": iso_components,
-            "windows_components": windows_components,
-            "components": filtered_components,
+            "builder_plugins": view.builder_plugins,
+            "iso_components": view.iso_components,
+            "windows_components": view.windows_components,
+            "components": view.regular_components,
             "template_labels": self.get_template_labels_conf(release),
             "template_aliases": self.get_template_alias_conf(release),
             "branches": self.get_branches_conf(release),
-            "maintainers": self.get_maintainers_conf(release)
+            "maintainers": self.get_maintainers_conf(release),
+            "build_waves": []
         }
+        if build_waves:
+            conf["build_waves"] = self.get_build_waves(
+                release, self.get_build_targets(release))[0]
+        return conf
+
+    def generate_conf(self, release, conf_file, build_waves=False):
+        return self.generate_confs([release], conf_file, build_waves)
+
+    def generate_confs(self, releases, conf_pattern, build_waves=False):
+        if 'all' in releases:
+            releases = list(self.releases)
+        for release in releases:
+            if release not in self.releases:
+                raise QubesComponentsManagerException(
+                    "Unknown release '%s'" % release)
+        if len(releases) > 1 and '{release}' not in conf_pattern:
+            raise QubesComponentsManagerException(
+                "Output '%s' needs a {release} field for generating "
+                "several releases" % conf_pattern)
+
+        template = self.get_template()
+        # views are built before rendering concurrently
+        confs = {release: self.get_conf(release, build_waves)
+                 for release in releases}
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(releases)) as executor:
+            rendered = {release: executor.submit(template.render, **conf)
+                        for release, conf in confs.items()}
+
+        written = []
+        for release in releases:
+            conf_file = conf_pattern.replace("{release}", release)
+            if not update_file(conf_file, rendered[release].result()):
+                logger.info("INFO: %s is unchanged" % conf_file)
+                continue
+            written.append(conf_file)
+        return written
 
-        generated_conf = template.render(**conf)
-        with open(conf_file, 'w') as fd:
-            fd.write(generated_conf)
+    def get_build_targets(self, release, req_dist=None,
+                          req_package_set=None):
+        # (package set, dist) builds of a release
+        targets = [("dom0", dist.name) for dist in self.dom0[release]] + \
+            [("vm", dist.name) for dist in self.vm[release]]
+        return [(package_set, dist) for package_set, dist in targets
+                if (not req_package_set or package_set == req_package_set)
+                and (not req_dist or dist in req_dist)]
+
+    def get_build_graph(self, release, targets):
+        # components of the release and the components each one build
+        # depends on for any of the (package set, dist) targets
+        view = self.get_release_view(release)
+        names = [component.name for component in view.components]
+        edges = {name: set() for name in names}
+        for component in view.components:
+            if component.get_dependencies(release) is None:
+                logger.error(
+                    "ERROR: No build dependencies for %s (%s). Run "
+                    "update." % (component, release))
+        for package_set, dist in targets:
+            # package and provided names -> first component building them
+            providers = {}
+            build_requires = {}
+            for component in view.components:
+                dependencies = (component.get_dependencies(release) or {}).get(
+                    package_set, {}).get(dist) or {}
+                packages = component.get_packages_list(release).get(
+                    package_set, {}).get(dist) or []
+                for name in list(packages) + list(
+                        dependencies.get("provides", [])):
+                    providers.setdefault(name, component.name)
+                build_requires[component.name] = \
+                    dependencies.get("build_requires", [])
+            for name, requires in build_requires.items():
+                for required in requires:
+                    provider = providers.get(required)
+                    if provider and provider != name:
+                        edges[name].add(provider)
+        return names, edges
+
+    def get_build_waves(self, release, targets, description=None):
+        # waves of components which can be built concurrently, and cycles
+        names, edges = self.get_build_graph(release, targets)
+        waves, cycles = get_build_waves(names, edges)
+        for cycle in cycles:
+            logger.error("ERROR: Build dependencies cycle in %s: %s" % (
+                description or release, ', '.join(cycle)))
+        return waves, cycles
+
+    def get_releases_build_waves(self, releases, req_dist=None,
+                                 req_package_set=None, merge=False):
+        # with merge, waves of a release are valid for all of its dists.
+        # Returns waves and cycles of every release and the cycles count.
+        if 'all' in releases:
+            releases = list(self.releases)
+        output = {}
+        cycles_count = 0
+        for release in releases:
+            if release not in self.releases:
+                raise QubesComponentsManagerException(
+                    "Unknown release '%s'" % release)
+            targets = self.get_build_targets(
+                release, req_dist, req_package_set)
+            if merge:
+                waves, cycles = self.get_build_waves(release, targets)
+                output[release] = {"waves": waves, "cycles": cycles}
+                cycles_count += len(cycles)
+                continue
+            output[release] = {}
+            for package_set, dist in targets:
+                waves, cycles = self.get_build_waves(
+                    release, [(package_set, dist)],
+                    "%s (%s, %s)" % (release, package_set, dist))
+                output[release].setdefault(package_set, {})[dist] = {
+                    "waves": waves,
+                    "cycles": cycles
+                }
+                cycles_count += len(cycles)
+        return output, cycles_count
 
     def get_component(self, name):
-        for component in self.components:
-            if component.name == name:
-                return component
+        return self.registry.get(name)
 
     def get_components_list(self):
-        components = [component.name for component in self.components]
-        return components
+        return self.registry.get_names()
 
     def get_components(self):
-        return self.components
+        return self.registry.components
 
     def get_components_from_name(self, components):
-        output = []
-        if 'all' in components:
-            return self.components
-        for component in components:
-            component = self.get_component(component)
-            if component:
-                output.append(component)
-        return output
+        return self.registry.get_from_names(components)
 
     # release.json (order + release info) + components/*.json -> distfile.json
     def create_distfile(self, distfile):
         with open(self.releasefile) as fd:
             data = json.loads(fd.read())
             data["components"] = {}
-        for component in self.data["components"]:
+        for component in self.get_components_list():
             try:
                 component_file = os.path.join(
                     self.components_folder, '%s.json' % component)
@@ -233,18 +509,363 @@ class ComponentsManagerCli:
         with open(component_file, 'w') as fd:
             fd.write(json.dumps(content, indent=4))
 
-    def update_components(self, components):
-        for component in self.get_components_from_name(components):
-            logger.debug("DEBUG: Update %s" % component)
+    def update_component(self, component, releases=None, changed_only=False,
+                         memo=None):
+        updated = False
+        for qubes_release in releases or component.releases:
+            dist_dom0 = self.dom0[qubes_release][0]
+            dists_vm = self.vm[qubes_release]
+            if changed_only and component.is_up_to_date(
+                    qubes_release, dist_dom0, dists_vm):
+                logger.debug("DEBUG: Skip unchanged %s (%s)" % (
+                    component, qubes_release))
+                continue
+            logger.debug("DEBUG: Update %s (%s)" % (component, qubes_release))
+            component.update(qubes_release, dist_dom0, dists_vm,
+                             worktrees=self.worktrees, cache=self.cache,
+                             makefile_backend=self.makefile_backend,
+                             rpm_backend=self.rpm_backend, memo=memo)
+            updated = True
+        return updated
+
+    def update_components_serially(self, components, changed_only=False,
+                                   memo=None):
+        # component name -> update_component result or raised exception
+        results = {}
+        for component in components:
+            try:
+                results[component.name] = self.update_component(
+                    component, None, changed_only, memo)
+            except Exception as e:
+                results[component.name] = e
+        return results
+
+    def write_component(self, component):
+        # files are only written if their content changed, returns the
+        # packages lists changes or None if the component file is unchanged
+        with trace.span("write", "io", component=component.name):
+            changes = None
             component_file = os.path.join(
                 self.components_folder, '%s.json' % component.name)
+            content = json.dumps(component.to_dict(), indent=4)
+            old_content = read_file(component_file)
+            if content != old_content:
+                try:
+                    old_data = json.loads(old_content or '{}')
+                except ValueError:
+                    old_data = {}
+                changes = component.get_changes(old_data)
+                write_file(component_file, content)
+            state_file = self.get_state_file(component.name)
+            os.makedirs(os.path.dirname(state_file), exist_ok=True)
+            update_file(state_file,
+                        json.dumps(component.to_state_dict(), indent=4))
+        return changes
+
+    def update_components(self, components, jobs=1, changed_only=False,
+                          report=None):
+        # report gets names of written components files and packages lists
+        # changes
+        failed = []
+        memo = QubesRunMemo()
+        components = self.get_components_from_name(components)
+        # without worktrees, mgmt-salt checkout is switched between branches
+        # while mgmt-salt-* components include its Makefile.builder: they
+        # are updated one after the other in a single task
+        mgmt_salt_components = [] if self.worktrees else [
+            component for component in components
+            if is_mgmt_salt_component(component.name)]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(jobs, 1)) as executor:
+            futures = []
+            mgmt_salt_task = None
+            for component in components:
+                # with worktrees, every release of a component has its own
+                # source tree and can be evaluated concurrently
+                if self.worktrees:
+                    tasks = [executor.submit(self.update_component, component,
+                                             [qubes_release], changed_only,
+                                             memo)
+                             for qubes_release in component.releases]
+                elif component in mgmt_salt_components:
+                    if not mgmt_salt_task:
+                        mgmt_salt_task = executor.submit(
+                            self.update_components_serially,
+                            mgmt_salt_components, changed_only, memo)
+                    tasks = [(mgmt_salt_task, component.name)]
+                else:
+                    tasks = [executor.submit(self.update_component, component,
+                                             None, changed_only, memo)]
+                futures.append((component, tasks))
+            # write components files in the requested order whatever
+            # the order of completion is
+            for component, tasks in futures:
+                try:
+                    updated = [get_task_result(task) for task in tasks]
+                except Exception as e:
+                    logger.error("ERROR: Failed to update %s: %s" % (
+                        component.name, str(e)))
+                    failed.append(component.name)
+                    continue
+                if not any(updated):
+                    continue
+                changes = self.write_component(component)
+                if changes is None:
+                    logger.debug("DEBUG: %s is unchanged" % component.name)
+                elif report is not None:
+                    report["written"].append(component.name)
+                    report["changes"] += changes
+        if self.worktrees:
+            self.worktrees.prune()
+        if self.cache:
+            self.cache.trim()
+            logger.info("INFO: Parse cache: %d hits, %d misses" % (
+                self.cache.hits, self.cache.misses))
+        logger.info("INFO: Run memo: %d hits, %d misses" % (
+            memo.hits, memo.misses))
+        return failed
+
+    def get_watched_dists(self, qubes_release, filenames):
+        # dists whose packages lists depend on the changed files,
+        # None for all of them
+        dists = set()
+        for filename in filenames:
+            basename = os.path.basename(filename)
+            if basename in ('Makefile.builder', 'version', 'rel'):
+                return None
+            is_spec = basename.endswith('.spec') or \
+                basename.endswith('.spec.in')
+            for dist in [self.dom0[qubes_release][0]] + \
+                    self.vm[qubes_release]:
+                if (is_spec and dist.is_rpm()) or \
+                        (not is_spec and dist.is_deb()):
+                    dists.add(dist.name)
+        return dists
 
+    def refresh_component(self, component, filenames):
+        # only releases built from the branch currently checked out in
+        # qubes-src can be updated from its content
+        branch = get_current_branch(component.orig_src)
+        memo = QubesRunMemo()
+        updated = False
+        for qubes_release in component.releases:
+            if component.branch.get(qubes_release) != branch:
+                logger.debug("DEBUG: Skip %s (%s): branch %s is not checked "
+                             "out" % (component, qubes_release,
+                                      component.branch.get(qubes_release)))
+                continue
+            dists = self.get_watched_dists(qubes_release, filenames)
+            if dists is not None and not dists:
+                continue
+            logger.info("INFO: Update %s (%s) for %s" % (
+                component, qubes_release, ', '.join(sorted(dists or ['all']))))
+            component.update(qubes_release, self.dom0[qubes_release][0],
+                             self.vm[qubes_release], dists=dists,
+                             from_checkout=True, cache=self.cache,
+                             makefile_backend=self.makefile_backend,
+                             rpm_backend=self.rpm_backend, memo=memo)
+            updated = True
+        if not updated:
+            return
+        for change in self.write_component(component) or []:
+            logger.info("INFO: %s (%s, %s, %s): %s" % (
+                component, change["qubes_release"], change["package_set"],
+                change["dist"], ' '.join(
+                    ['+%s' % pkg for pkg in change["added"]] +
+                    ['-%s' % pkg for pkg in change["removed"]])))
+
+    def watch_components(self, components, debounce=0.3):
+        components = {component.name: component for component in
+                      self.get_components_from_name(components)}
+        watcher = QubesSourcesWatcher(
+            {name: component.orig_src
+             for name, component in components.items()},
+            debounce=debounce)
+        if watcher.is_polling():
+            logger.info("INFO: inotify is not available, polling sources")
+        logger.info("INFO: Watching %d components" % len(components))
+        try:
+            while True:
+                for name, filenames in sorted(watcher.wait().items()):
+                    logger.debug("DEBUG: Changed in %s: %s" % (
+                        name, ', '.join(sorted(filenames))))
+                    try:
+                        self.refresh_component(components[name], filenames)
+                    except Exception as e:
+                        logger.error("ERROR: Failed to update %s: %s" % (
+                            name, str(e)))
+                if self.cache:
+                    self.cache.trim()
+        finally:
+            watcher.close()
+
+    def get_range_changes(self, ranges):
+        # 'COMPONENT:COMMITS' -> component -> (changed files, last commit)
+        changes = {}
+        for commits_range in ranges:
+            name, _, commits = commits_range.partition(':')
+            component = self.get_component(name)
+            if not commits:
+                raise QubesComponentsManagerException(
+                    "Invalid range '%s'" % commits_range)
+            if not component:
+                raise QubesComponentsManagerException(
+                    "Unknown component '%s'" % name)
+            try:
+                filenames = get_changed_files(component.orig_src, commits)
+            except (subprocess.CalledProcessError, FileNotFoundError):
+                raise QubesComponentsManagerException(
+                    "Cannot get files changed by %s in %s" % (
+                        commits, component.orig_src))
+            last_commit = commits.split('..')[-1].lstrip('.') or 'HEAD'
+            previous = changes.get(name, ([], None))[0]
+            changes[name] = (previous + filenames,
+                             get_commit(component.orig_src, last_commit))
+        return changes
+
+    def get_paths_changes(self, paths):
+        # paths relative to qubes-src -> component -> (changed files, None)
+        changes = {}
+        for path in paths:
+            path = os.path.normpath(path)
+            if path.startswith('qubes-src' + os.sep):
+                path = path[len('qubes-src' + os.sep):]
+            name, _, filename = path.partition(os.sep)
+            if not filename:
+                continue
+            if not self.get_component(name):
+                logger.debug("DEBUG: Ignore %s: unknown component" % path)
+                continue
+            changes.setdefault(name, ([], None))[0].append(filename)
+        return changes
+
+    def get_affected(self, changes, req_release=None, raw=False,
+                     req_format=None):
+        # Minimal rebuild set: components releases and dists whose packages
+        # lists or NVRs depend on changed files, with their packages. A
+        # release is skipped when its branch does not contain the last
+        # commit of a range.
+        mgmt_salt_changes = changes.get('mgmt-salt')
+        if mgmt_salt_changes and 'Makefile.builder' in mgmt_salt_changes[0]:
+            # included by Makefile.builder of every mgmt-salt-* component
+            for component in self.get_components():
+                if component.name.startswith('mgmt-salt-'):
+                    filenames, commit = changes.get(component.name, ([], None))
+                    changes[component.name] = (
+                        filenames + ['Makefile.builder'], commit)
+
+        affected = {}
+        records = []
+        missing = []
+        for component in self.get_components_from_name(list(changes)):
+            filenames, commit = changes[component.name]
             for qubes_release in component.releases:
-                component.update(qubes_release, self.dom0[qubes_release][0],
-                                 self.vm[qubes_release])
+                if req_release and qubes_release not in req_release:
+                    continue
+                if commit:
+                    branch_commit = get_commit(
+                        component.orig_src, component.branch[qubes_release])
+                    if branch_commit and not is_ancestor(
+                            component.orig_src, commit, branch_commit):
+                        logger.debug(
+                            "DEBUG: Skip %s (%s): %s is not in branch %s" % (
+                                component, qubes_release, commit,
+                                component.branch[qubes_release]))
+                        continue
+                packages_list = component.get_nvr_packages_list(
+                    qubes_release) or component.get_packages_list(
+                    qubes_release)
+                if packages_list is None:
+                    missing.append("%s (%s)" % (component, qubes_release))
+                    continue
+                dists = {
+                    "dom0": [self.dom0[qubes_release][0].name],
+                    "vm": [dist.name for dist in self.vm[qubes_release]]
+                }
+                affected_dists = component.get_affected_dists(
+                    qubes_release, dists, filenames)
+                for package_set, dists_names in affected_dists.items():
+                    for dist in dists_names:
+                        packages = packages_list.get(
+                            package_set, {}).get(dist) or []
+                        # nothing to rebuild unless dists resolution changes
+                        if not packages and \
+                                'Makefile.builder' not in filenames:
+                            continue
+                        affected.setdefault(component.name, {}).setdefault(
+                            qubes_release, {}).setdefault(
+                            package_set, {})[dist] = packages
+                        records.append({
+                            "component": component.name,
+                            "qubes_release": qubes_release,
+                            "package_set": package_set,
+                            "dist": dist,
+                            "packages": ' '.join(packages)
+                        })
+        if raw:
+            if not req_format:
+                req_format = AVAILABLE_FORMAT_ITEMS[:-1]
+            req_format = ':'.join('{%s}' % f for f in req_format)
+            return [req_format.format(**record) for record in records], \
+                missing
+        return affected, missing
 
-            with open(component_file, 'w') as fd:
-                fd.write(json.dumps(component.to_dict(), indent=4))
+    def check_makefiles(self, components):
+        checked = 0
+        unsupported_count = 0
+        differences_count = 0
+        for component in self.get_components_from_name(components):
+            for qubes_release in component.releases:
+                differences, unsupported = component.compare_builder_values(
+                    qubes_release, self.dom0[qubes_release][0],
+                    self.vm[qubes_release], worktrees=self.worktrees)
+                for package_set, dist, reason in unsupported:
+                    logger.info("INFO: %s (%s, %s, %s): %s" % (
+                        component, qubes_release, package_set, dist, reason))
+                for package_set, dist, var, python_value, make_value in \
+                        differences:
+                    logger.error(
+                        "ERROR: %s (%s, %s, %s): %s is '%s' with Python "
+                        "evaluation and '%s' with make" % (
+                            component, qubes_release, package_set, dist, var,
+                            python_value, make_value))
+                checked += 1
+                unsupported_count += len(unsupported)
+                differences_count += len(differences)
+        print("Checked %d components releases: %d contexts not supported by "
+              "Python evaluation, %d differences" % (
+                  checked, unsupported_count, differences_count))
+        return differences_count
+
+    def check_specs(self, components):
+        checked = 0
+        unsupported_count = 0
+        differences_count = 0
+        for component in self.get_components_from_name(components):
+            for qubes_release in component.releases:
+                differences, unsupported = component.compare_spec_packages(
+                    qubes_release, self.dom0[qubes_release][0],
+                    self.vm[qubes_release], worktrees=self.worktrees,
+                    backend=self.rpm_backend)
+                for package_set, dist, spec, reason in unsupported:
+                    logger.info("INFO: %s (%s, %s, %s): %s: %s" % (
+                        component, qubes_release, package_set, dist, spec,
+                        reason))
+                for package_set, dist, spec, native_packages, \
+                        rpm_packages in differences:
+                    logger.error(
+                        "ERROR: %s (%s, %s, %s): %s gives %s with native "
+                        "parser and %s with rpm" % (
+                            component, qubes_release, package_set, dist, spec,
+                            json.dumps(native_packages),
+                            json.dumps(rpm_packages)))
+                checked += 1
+                unsupported_count += len(unsupported)
+                differences_count += len(differences)
+        print("Checked %d components releases: %d specs not supported by "
+              "native parser, %d differences" % (
+                  checked, unsupported_count, differences_count))
+        return differences_count
 
     def get_packages_list(self, component, qubes_release, with_nvr=False):
         logger.debug("DEBUG: Get packages list for %s" % component)
@@ -254,60 +875,144 @@ class ComponentsManagerCli:
             packages_list = component.get_packages_list(qubes_release)
         return packages_list
 
+    def iter_component_packages_lists(self, component, req_dist=None,
+                                      req_package_set=None, with_nvr=False,
+                                      skip_empty=False, req_release=None):
+        # yields filtered packages list of every release of the component
+        for qubes_release in component.releases:
+            if req_release and qubes_release != req_release:
+                continue
+            packages_list = self.get_packages_list(
+                component, qubes_release, with_nvr)
+            if packages_list is None:
+                raise QubesComponentsManagerException(
+                    "No packages list with NVR for %s (%s). Run update or "
+                    "use --refresh." % (component, qubes_release))
+            filtered_packages_list = {}
+            for package_set in packages_list.keys():
+                if req_package_set and package_set != req_package_set:
+                    continue
+                filtered_list = {}
+                for k, v in packages_list[package_set].items():
+                    if req_dist and k not in req_dist:
+                        continue
+                    if skip_empty and not v:
+                        continue
+                    filtered_list[k] = v
+                filtered_packages_list[package_set] = filtered_list
+            yield qubes_release, filtered_packages_list
+
+    def iter_packages_records(self, components, **kwargs):
+        # yields one record per component, release, package set and dist
+        # as components are processed
+        for component in self.get_components_from_name(components):
+            for qubes_release, packages_list in \
+                    self.iter_component_packages_lists(component, **kwargs):
+                for package_set, dists in packages_list.items():
+                    for dist, packages in dists.items():
+                        if packages is None:
+                            continue
+                        yield {
+                            "component": component.name,
+                            "qubes_release": qubes_release,
+                            "package_set": package_set,
+                            "dist": dist,
+                            "packages": packages
+                        }
+
     def get_components_packages_list(self, components, req_dist=None, raw=False,
                                      req_package_set=None, with_nvr=False,
                                      req_format=None, skip_empty=False,
                                      req_release=None):
+        kwargs = {
+            "req_dist": req_dist,
+            "req_package_set": req_package_set,
+            "with_nvr": with_nvr,
+            "skip_empty": skip_empty,
+            "req_release": req_release
+        }
+        if raw:
+            if not req_format:
+                req_format = ["packages"]
+            req_format = ':'.join('{%s}' % f for f in req_format)
+            output = []
+            for record in self.iter_packages_records(components, **kwargs):
+                output.append(req_format.format(
+                    **dict(record, packages=' '.join(record["packages"]))))
+            return output
+
         pkgs = {}
-        pkgs_with_format = []
+        for component in self.get_components_from_name(components):
+            pkgs[component.name] = {}
+            for qubes_release, packages_list in \
+                    self.iter_component_packages_lists(component, **kwargs):
+                pkgs[component.name][qubes_release] = packages_list
+        return pkgs
+
+    def write_packages_records(self, stream, components, output='ndjson',
+                               req_format=None, **kwargs):
+        # output is flushed after every component so that consumers can
+        # start before all components are processed
+        if not req_format:
+            req_format = AVAILABLE_FORMAT_ITEMS
+        component = None
+        for record in self.iter_packages_records(components, **kwargs):
+            if component and record["component"] != component:
+                stream.flush()
+            component = record["component"]
+            if output == 'ndjson':
+                stream.write(json.dumps(record) + '\n')
+            else:
+                record["packages"] = ' '.join(record["packages"])
+                stream.write(
+                    '\t'.join(record[field] for field in req_format) + '\n')
+        stream.flush()
 
+    def get_reverse_index(self):
+        if self.reverse_index is None:
+            self.reverse_index = QubesReverseIndex.from_components(
+                self.registry.components)
+        return self.reverse_index
+
+    def which(self, names, raw=False, req_format=None):
+        reverse_index = self.get_reverse_index()
         if not req_format:
-            req_format = ["packages"]
+            req_format = WHICH_FORMAT_ITEMS
         req_format = ':'.join('{%s}' % f for f in req_format)
 
-        for component in self.get_components_from_name(components):
-            pkgs[component.name] = {}
-            for qubes_release in component.releases:
-                if req_release and qubes_release != req_release:
-                    continue
-                packages_list = self.get_packages_list(
-                    component, qubes_release, with_nvr)
-                if req_package_set:
-                    if req_package_set == "dom0":
-                        del packages_list["vm"]
-                    else:
-                        del packages_list["dom0"]
-                pkgs[component.name][qubes_release] = {}
-                for package_set in packages_list.keys():
-                    filtered_list = {}
-                    for k, v in packages_list[package_set].items():
-                        if req_dist and k not in req_dist:
-                            continue
-                        if skip_empty and not v:
-                            continue
-                        filtered_list[k] = v
-
-                    pkgs[component.name][qubes_release][package_set] = \
-                        filtered_list
-
-                    for dist in pkgs[component.name][qubes_release][package_set].keys():
-                        component_packages_list = \
-                            pkgs[component.name][qubes_release][package_set][dist]
-                        if component_packages_list is not None:
-                            pkgs_with_format.append(
-                                req_format.format(
-                                    component=component.name,
-                                    qubes_release=qubes_release,
-                                    package_set=package_set,
-                                    dist=dist,
-                                    packages=' '.join(component_packages_list)
-                                )
-                            )
+        found = {}
+        found_with_format = []
+        missing = []
+        for name in names:
+            entries = reverse_index.lookup(name)
+            if not entries:
+                missing.append(name)
+            found[name] = entries
+            if raw:
+                for entry in entries:
+                    found_with_format.append(
+                        req_format.format(name=name, **entry))
         if raw:
-            output = pkgs_with_format
+            output = found_with_format
         else:
-            output = pkgs
-        return output
+            output = found
+        return output, missing
+
+
+def is_mgmt_salt_component(name):
+    # mgmt-salt-* Makefile.builder files include the mgmt-salt one
+    return name == 'mgmt-salt' or 'mgmt-salt-' in name
+
+
+def get_task_result(task):
+    # task is a future or a (future, component name) of a serial update
+    if isinstance(task, tuple):
+        future, name = task
+        result = future.result()[name]
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return task.result()
 
 
 def get_args():
@@ -327,6 +1032,61 @@ def get_args():
         help="Local path of Qubes sources.",
         default=os.path.join(os.getcwd(), 'qubes-builder/qubes-src')
     )
+    parser.add_argument(
+        "--worktrees-dir",
+        help="Evaluate components branches in dedicated git worktrees stored "
+             "in this folder instead of checking out branches in qubes-src."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Folder for caching parsing results and components index "
+             "(default: %s)." %
+             DEFAULT_CACHE_DIR,
+        default=DEFAULT_CACHE_DIR
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="Maximum size of the parse cache in MiB."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use the parse cache and components index."
+    )
+    parser.add_argument(
+        "--makefile-backend",
+        choices=["auto", "make"],
+        default="auto",
+        help="Evaluate Makefile.builder in Python when possible ('auto') "
+             "or always with make."
+    )
+    parser.add_argument(
+        "--rpm-backend",
+        choices=["auto", "rpm", "rpmspec"],
+        default="auto",
+        help="Query spec files with rpm Python bindings ('rpm') or "
+             "rpmspec. 'auto' uses the native spec parser and falls back "
+             "to the bindings when available or to rpmspec."
+    )
+    parser.add_argument(
+        "--socket",
+        help="Unix socket of the daemon started by 'serve' (default: %s)." %
+             DEFAULT_SOCKET,
+        default=DEFAULT_SOCKET
+    )
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="Do not forward queries to a running daemon."
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="TRACE_FILE",
+        help="Write a trace of the run in Chrome trace format (viewable "
+             "with Perfetto or chrome://tracing) and print a summary."
+    )
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -346,16 +1106,42 @@ def get_args():
         nargs='+',
         help="Update packages list for given components. 'all' is accepted."
     )
+    update_parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=1,
+        help="Number of components to update concurrently."
+    )
+    update_parser.add_argument(
+        "--changed-only",
+        action="store_true",
+        help="Skip components releases whose branch has not moved since "
+             "their packages lists were computed."
+    )
+    update_parser.add_argument(
+        "--report",
+        help="Write a JSON report of the components files written and of "
+             "the packages gained or lost by every component, release and "
+             "dist. '-' is the standard output."
+    )
 
     generate_parser = subparser.add_parser('generate', help='Generate')
     generate_parser.add_argument(
         "--builder-conf",
-        help="Destination file for generating qubes-builder configuration file."
+        help="Destination file for generating qubes-builder configuration file. "
+             "'{release}' is replaced by the Qubes release."
     )
     generate_parser.add_argument(
         "--release",
-        help="Qubes release to work with.",
-        default="4.1"
+        nargs='+',
+        help="Qubes releases to work with. 'all' is accepted.",
+        default=["4.1"]
+    )
+    generate_parser.add_argument(
+        "--build-waves",
+        action="store_true",
+        help="Add components build waves to qubes-builder configuration "
+             "file. See build-waves command."
     )
     generate_parser.add_argument(
         "--component-skeleton",
@@ -366,6 +1152,24 @@ def get_args():
         help="Create a distribution file with all the Qubes components info."
     )
 
+    check_parser = subparser.add_parser('check', help='Check')
+    check_parser.add_argument(
+        "--components",
+        default=['all'],
+        nargs='+',
+        help="Components to check. 'all' is accepted."
+    )
+    check_parser.add_argument(
+        "--makefile",
+        action="store_true",
+        help="Compare Python and make evaluations of Makefile.builder."
+    )
+    check_parser.add_argument(
+        "--spec",
+        action="store_true",
+        help="Compare native spec parser and rpm results for every spec."
+    )
+
     get_parser = subparser.add_parser('get', help='Get')
     get_parser.add_argument(
         "--packages-list",
@@ -378,6 +1182,12 @@ def get_args():
         action="store_true",
         help="Output with version and release build tag."
     )
+    get_parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Update packages lists of given components before output "
+             "instead of using the ones stored by last update."
+    )
     get_parser.add_argument(
         "--raw",
         action="store_true",
@@ -388,6 +1198,14 @@ def get_args():
         help="Provide format as colon separated fields. "
              "Available fields: component, qubes_release, package_set, dist, packages."
     )
+    get_parser.add_argument(
+        "--output",
+        choices=["json", "ndjson", "tsv"],
+        default="json",
+        help="Output format. 'ndjson' and 'tsv' write one line per "
+             "component, release, package set and dist as soon as it is "
+             "available. TSV fields can be selected with --format."
+    )
     get_parser.add_argument(
         "--skip-empty",
         action="store_true",
@@ -406,9 +1224,229 @@ def get_args():
         "--release",
         help="Filter Qubes release."
     )
+
+    which_parser = subparser.add_parser(
+        'which', help='Find components providing packages')
+    which_parser.add_argument(
+        "names",
+        nargs='*',
+        default=['-'],
+        help="Package names or built files names. Read from standard input "
+             "when '-' or not provided."
+    )
+    which_parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="Raw output. Format can be specified. See --format"
+    )
+    which_parser.add_argument(
+        "--format",
+        help="Provide format as colon separated fields. "
+             "Available fields: name, component, qubes_release, package_set, dist."
+    )
+
+    build_waves_parser = subparser.add_parser(
+        'build-waves',
+        help='Order components in waves of components which only build '
+             'depend on components of previous waves and can be built '
+             'concurrently.')
+    build_waves_parser.add_argument(
+        "--release",
+        nargs='+',
+        default=['all'],
+        help="Qubes releases to work with. 'all' is accepted."
+    )
+    build_waves_parser.add_argument(
+        "--dist",
+        nargs='+',
+        help="Filter distributions."
+    )
+    build_waves_parser.add_argument(
+        "--package-set",
+        help="Filter package set."
+    )
+    build_waves_parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Compute waves of every release valid for all its selected "
+             "package sets and dists at once."
+    )
+
+    watch_parser = subparser.add_parser(
+        'watch',
+        help='Update packages lists of components as soon as their sources '
+             'in qubes-src are modified.')
+    watch_parser.add_argument(
+        "--packages-list",
+        default=['all'],
+        nargs='+',
+        help="Components to watch. 'all' is accepted."
+    )
+    watch_parser.add_argument(
+        "--debounce",
+        type=float,
+        default=0.3,
+        help="Seconds without changes to wait for before updating "
+             "(default: 0.3)."
+    )
+
+    affected_parser = subparser.add_parser(
+        'affected',
+        help='Find components releases and dists whose packages lists or '
+             'NVRs change with given commits or changed files.')
+    affected_parser.add_argument(
+        "--range",
+        nargs='+',
+        default=[],
+        help="Commits of components as COMPONENT:COMMITS where COMMITS is "
+             "a range 'A..B' or a single commit."
+    )
+    affected_parser.add_argument(
+        "--paths",
+        help="File of changed paths relative to qubes-src, one per line. "
+             "Read from standard input when '-'."
+    )
+    affected_parser.add_argument(
+        "--release",
+        nargs='+',
+        help="Filter Qubes releases."
+    )
+    affected_parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="Raw output. Format can be specified. See --format"
+    )
+    affected_parser.add_argument(
+        "--format",
+        help="Provide format as colon separated fields. "
+             "Available fields: component, qubes_release, package_set, dist, "
+             "packages."
+    )
+
+    subparser.add_parser(
+        'serve',
+        help='Answer get, which and generate queries from a daemon listening '
+             'on --socket. Components files are reloaded when they change.')
     return parser.parse_args()
 
 
+def get_command_components(args):
+    # components a command works on and whether it needs their sources
+    if args.command in ('update', 'watch'):
+        return args.packages_list, True
+    if args.command == 'generate':
+        if args.builder_conf or args.distfile:
+            return ['all'], False
+        return None, False
+    if args.command == 'check':
+        return args.components, True
+    if args.command == 'get':
+        return args.packages_list, args.refresh
+    if args.command in ('which', 'serve', 'build-waves', 'affected'):
+        return ['all'], False
+    return None, False
+
+
+def set_log_level(args):
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    elif args.verbose:
+        logger.setLevel(logging.INFO)
+    else:
+        logger.setLevel(logging.ERROR)
+
+
+def get_daemon_request(args):
+    # paths are made absolute and standard input is read here as the
+    # daemon has neither the current folder nor the standard input
+    request_args = dict(vars(args))
+    for key in ("releasefile", "components_folder", "qubes_src",
+                "builder_conf", "distfile"):
+        if request_args.get(key):
+            request_args[key] = os.path.abspath(request_args[key])
+    if args.command == 'which':
+        names = []
+        for name in args.names:
+            if name == '-':
+                names += sys.stdin.read().split()
+            else:
+                names.append(name)
+        request_args["names"] = names
+    return {"args": request_args}
+
+
+def forward_to_daemon(args):
+    # returns None if no daemon can answer
+    if args.no_daemon or args.profile or args.command not in DAEMON_COMMANDS:
+        return None
+    if args.command == 'get' and args.refresh:
+        return None
+    if args.command == 'generate' and args.component_skeleton:
+        return None
+    if not os.path.exists(args.socket):
+        return None
+    try:
+        response = send_request(args.socket, get_daemon_request(args))
+    except (OSError, QubesDaemonException) as e:
+        logger.debug("DEBUG: Cannot use daemon: %s" % str(e))
+        return None
+    if "error" in response:
+        logger.debug("DEBUG: Daemon refused query: %s" % response["error"])
+        return None
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return response["returncode"]
+
+
+def handle_daemon_request(cli, request):
+    args = argparse.Namespace(**request["args"])
+    if args.command not in DAEMON_COMMANDS:
+        return {"error": "Unsupported command '%s'" % args.command}
+    for key in ("releasefile", "components_folder", "qubes_src"):
+        if getattr(args, key) != os.path.abspath(getattr(cli, key)):
+            return {"error": "Daemon serves another %s" % key}
+
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    handler = logging.StreamHandler(stderr)
+    logger.removeHandler(console_handler)
+    logger.addHandler(handler)
+    set_log_level(args)
+    try:
+        cli.stamps = cli.reload_changed_components(cli.stamps)
+        with contextlib.redirect_stdout(stdout):
+            returncode = run_command(cli, args)
+    except Exception as e:
+        logger.error("ERROR: %s" % str(e))
+        returncode = 1
+    finally:
+        logger.removeHandler(handler)
+        logger.addHandler(console_handler)
+    return {
+        "returncode": returncode or 0,
+        "stdout": stdout.getvalue(),
+        "stderr": stderr.getvalue()
+    }
+
+
+def serve(cli, socket_path):
+    try:
+        daemon = QubesDaemon(
+            socket_path, lambda request: handle_daemon_request(cli, request))
+    except QubesDaemonException as e:
+        logger.error("ERROR: %s" % str(e))
+        return 1
+    logger.info("INFO: Listening on %s" % socket_path)
+    # remove the socket when stopped by a service manager too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+
+
 def main():
     args = get_args()
 
@@ -419,33 +1457,83 @@ def main():
     if not os.path.exists(args.components_folder):
         logger.error("ERROR: Cannot find components folder %s" % args.components_folder)
         return 1
-    if not os.path.exists(args.qubes_src):
+    components, need_sources = get_command_components(args)
+    if need_sources and not os.path.exists(args.qubes_src):
         logger.error("ERROR: Cannot find qubes-src folder")
         return 1
-    if args.debug:
-        logger.setLevel(logging.DEBUG)
-    elif args.verbose:
-        logger.setLevel(logging.INFO)
-    else:
-        logger.setLevel(logging.ERROR)
+    set_log_level(args)
+
+    returncode = forward_to_daemon(args)
+    if returncode is not None:
+        return returncode
 
     cli = ComponentsManagerCli(
         releasefile=args.releasefile,
         components_folder=args.components_folder,
-        qubes_src=os.path.abspath(args.qubes_src)
+        qubes_src=os.path.abspath(args.qubes_src),
+        worktrees_dir=args.worktrees_dir,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        cache_size=args.cache_size * 1024 * 1024,
+        makefile_backend=args.makefile_backend,
+        rpm_backend=args.rpm_backend
     )
-    cli.init()
+    tracer = None
+    if args.profile:
+        tracer = trace.enable()
+    try:
+        with trace.span(args.command or "init", "command"):
+            cli.init()
+            if args.command == 'serve':
+                # taken before reading files for the daemon to reload
+                # the ones changed meanwhile
+                cli.stamps = cli.get_inputs_stamps()
+            if components:
+                cli.load_components(components, need_sources=need_sources)
+            if args.command == 'serve':
+                return serve(cli, args.socket)
+            return run_command(cli, args)
+    finally:
+        if tracer:
+            tracer.write(args.profile)
+            print(tracer.get_summary(cli.cache), file=sys.stderr)
 
+
+def run_command(cli, args):
     if args.command == 'update':
         if args.packages_list:
-            cli.update_components(args.packages_list)
+            report = {"written": [], "changes": []}
+            failed = cli.update_components(
+                args.packages_list, jobs=args.jobs,
+                changed_only=args.changed_only, report=report)
+            if args.report == '-':
+                print(json.dumps(report, indent=4))
+            elif args.report:
+                write_file(args.report, json.dumps(report, indent=4))
+            if failed:
+                return 1
+    elif args.command == 'watch':
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            cli.watch_components(args.packages_list, debounce=args.debounce)
+        except KeyboardInterrupt:
+            pass
     elif args.command == 'generate':
         if args.builder_conf and args.release:
-            cli.generate_conf(args.release, args.builder_conf)
+            try:
+                cli.generate_confs(args.release, args.builder_conf,
+                                   build_waves=args.build_waves)
+            except QubesComponentsManagerException as e:
+                logger.error("ERROR: %s" % str(e))
+                return 1
         if args.component_skeleton:
             cli.add_component(args.component_skeleton)
         if args.distfile:
             cli.create_distfile(args.distfile)
+    elif args.command == 'check':
+        if args.makefile and cli.check_makefiles(args.components):
+            return 1
+        if args.spec and cli.check_specs(args.components):
+            return 1
     elif args.command == 'get':
         if args.package_set and args.package_set not in ("dom0", "vm"):
             logger.error("ERROR: Invalid package set provided")
@@ -458,22 +1546,116 @@ def main():
                     logger.error("ERROR: Unsupported format '%s'" % fmt)
                     return 1
         if args.packages_list:
-            if args.with_nvr:
-                cli.update_components(args.packages_list)
-            pkgs_list = cli.get_components_packages_list(
-                args.packages_list,
-                with_nvr=args.with_nvr,
-                raw=args.raw,
-                skip_empty=args.skip_empty,
-                req_format=requested_format,
-                req_dist=args.dist,
-                req_package_set=args.package_set,
-                req_release=args.release,
-            )
+            if args.refresh:
+                if cli.update_components(args.packages_list):
+                    return 1
+            try:
+                if args.output in ('ndjson', 'tsv'):
+                    cli.write_packages_records(
+                        sys.stdout,
+                        args.packages_list,
+                        output=args.output,
+                        req_format=requested_format,
+                        with_nvr=args.with_nvr,
+                        skip_empty=args.skip_empty,
+                        req_dist=args.dist,
+                        req_package_set=args.package_set,
+                        req_release=args.release,
+                    )
+                    return
+                pkgs_list = cli.get_components_packages_list(
+                    args.packages_list,
+                    with_nvr=args.with_nvr,
+                    raw=args.raw,
+                    skip_empty=args.skip_empty,
+                    req_format=requested_format,
+                    req_dist=args.dist,
+                    req_package_set=args.package_set,
+                    req_release=args.release,
+                )
+            except QubesComponentsManagerException as e:
+                logger.error("ERROR: %s" % str(e))
+                return 1
             if not args.raw:
                 print(json.dumps(pkgs_list, indent=4))
             else:
                 print('\n'.join(pkgs_list))
+    elif args.command == 'build-waves':
+        if args.package_set and args.package_set not in ("dom0", "vm"):
+            logger.error("ERROR: Invalid package set provided")
+            return 1
+        try:
+            build_waves, cycles_count = cli.get_releases_build_waves(
+                args.release, req_dist=args.dist,
+                req_package_set=args.package_set, merge=args.merge)
+        except QubesComponentsManagerException as e:
+            logger.error("ERROR: %s" % str(e))
+            return 1
+        print(json.dumps(build_waves, indent=4))
+        if cycles_count:
+            return 1
+    elif args.command == 'affected':
+        requested_format = None
+        if args.format:
+            requested_format = args.format.split(':')
+            for fmt in requested_format:
+                if fmt not in AVAILABLE_FORMAT_ITEMS:
+                    logger.error("ERROR: Unsupported format '%s'" % fmt)
+                    return 1
+        if not args.range and not args.paths:
+            logger.error("ERROR: Provide --range or --paths")
+            return 1
+        try:
+            changes = cli.get_range_changes(args.range)
+            if args.paths == '-':
+                paths = sys.stdin.read().split()
+            elif args.paths:
+                with open(args.paths) as fd:
+                    paths = fd.read().split()
+            else:
+                paths = []
+            for name, (filenames, _) in cli.get_paths_changes(
+                    paths).items():
+                previous, commit = changes.get(name, ([], None))
+                changes[name] = (previous + filenames, commit)
+        except (QubesComponentsManagerException, OSError) as e:
+            logger.error("ERROR: %s" % str(e))
+            return 1
+        affected, missing = cli.get_affected(
+            changes, req_release=args.release, raw=args.raw,
+            req_format=requested_format)
+        if not args.raw:
+            print(json.dumps(affected, indent=4))
+        elif affected:
+            print('\n'.join(affected))
+        for name in missing:
+            logger.error("ERROR: No packages list for %s. Run update." % name)
+        if missing:
+            return 1
+    elif args.command == 'which':
+        requested_format = None
+        if args.format:
+            requested_format = args.format.split(':')
+            for fmt in requested_format:
+                if fmt not in WHICH_FORMAT_ITEMS:
+                    logger.error("ERROR: Unsupported format '%s'" % fmt)
+                    return 1
+        names = []
+        for name in args.names:
+            if name == '-':
+                names += sys.stdin.read().split()
+            else:
+                names.append(name)
+        found, missing = cli.which(
+            names, raw=args.raw, req_format=requested_format)
+        if not args.raw:
+            print(json.dumps(found, indent=4))
+        elif found:
+            print('\n'.join(found))
+        for name in missing:
+            logger.error("ERROR: Cannot find component providing %s" % name)
+        if missing:
+            return 1
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+# bump when the format or the computation of cached values changes
+CACHE_VERSION = 3
+
+
+# Persistent cache of parsing results. Keys are built from the hashes of
+# the parsed inputs so that entries never need to be invalidated, only
+# evicted: least recently used entries are removed when the cache grows
+# bigger than max_size bytes.
+class QubesParseCache:
+    def __init__(self, path, max_size=256 * 1024 * 1024):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(*items):
+        content = json.dumps([CACHE_VERSION] + list(items))
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            with open(path) as fd:
+                value = json.loads(fd.read())["value"]
+            # mtime tracks last use for eviction
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            with self.lock:
+                self.misses += 1
+            raise KeyError(key)
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                'w', dir=os.path.dirname(path), delete=False) as fd:
+            fd.write(json.dumps({"value": value}))
+        os.replace(fd.name, path)
+
+    def trim(self):
+        if not os.path.exists(self.path):
+            return
+        entries = []
+        for subdir in os.scandir(self.path):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+# Results computed during one run, shared by every component, release and
+# dist evaluating identical inputs (e.g. a spec rendered the same for fc32
+# dom0 and vm, or releases whose branches point to one commit). Unlike the
+# parse cache, it is kept in memory and used even when the cache is disabled.
+class QubesRunMemo:
+    def __init__(self):
+        self.values = {}
+        # key -> lock held while its value is being computed
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.values[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+
+    def get_or_compute(self, key, func):
+        # concurrent lookups of a key being computed wait for its value
+        # instead of computing it again
+        with self.lock:
+            if key in self.values:
+                self.hits += 1
+                return self.values[key]
+            key_lock = self.pending.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                if key in self.values:
+                    self.hits += 1
+                    return self.values[key]
+                self.misses += 1
+            value = func()
+            with self.lock:
+                self.values[key] = value
+                self.pending.pop(key, None)
+        return value
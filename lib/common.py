@@ -1,7 +1,130 @@
 import os
+import re
+import stat
+import hashlib
 import tempfile
+import threading
 import subprocess
 
+from lib import trace
+from lib.makefile import MakefileEvaluator, MakefileUnsupportedException
+
+# command used for evaluating Makefile.builder files
+MAKE = "make"
+
+
+def get_blob_hash(path):
+    # same value as 'git hash-object' without forking git
+    try:
+        with open(path, 'rb') as fd:
+            content = fd.read()
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    header = ('blob %d\0' % len(content)).encode('utf-8')
+    return hashlib.sha1(header + content).hexdigest()
+
+
+# constructs making the evaluation of a Makefile.builder or spec file read
+# other files than itself, which its hash does not cover
+MAKEFILE_EXTERNAL_INPUTS_REGEX = re.compile(
+    rb"^[ \t]*-?s?include[ \t]|\$[({](?:wildcard|shell|file)[ \t]|!=",
+    flags=re.MULTILINE)
+SPEC_EXTERNAL_INPUTS_REGEX = re.compile(
+    rb"%include[ \t]|%\(|%\{(?:lua|load):|%load[ \t]")
+
+
+def has_external_inputs(path, regex):
+    try:
+        with open(path, 'rb') as fd:
+            content = fd.read()
+    except (FileNotFoundError, IsADirectoryError):
+        return False
+    return regex.search(content) is not None
+
+
+def read_file(path):
+    try:
+        with open(path) as fd:
+            return fd.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_file(path, content):
+    # written aside then renamed so that readers never see a partial file
+    tmp_path = os.path.join(os.path.dirname(path), '.%s.%d.%d.tmp' % (
+        os.path.basename(path), os.getpid(), threading.get_ident()))
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        try:
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def update_file(path, content):
+    # returns False without touching the file if it has this content
+    if read_file(path) == content:
+        return False
+    write_file(path, content)
+    return True
+
+
+def get_commit(path, branch):
+    # local branch first then remote one like 'git checkout' does
+    for ref in (branch, 'origin/%s' % branch):
+        try:
+            with trace.span("git rev-parse", "subprocess"):
+                output = subprocess.check_output(
+                    ["git", "rev-parse", "--verify", "-q",
+                     "%s^{commit}" % ref],
+                    cwd=path, text=True, stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            continue
+        return output.rstrip('\n')
+
+
+def get_current_branch(path):
+    # None for a detached HEAD
+    try:
+        with trace.span("git symbolic-ref", "subprocess"):
+            output = subprocess.check_output(
+                ["git", "symbolic-ref", "--short", "-q", "HEAD"],
+                cwd=path, text=True, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return None
+    return output.rstrip('\n') or None
+
+
+def get_changed_files(path, commits):
+    # files changed by a range 'A..B' or by a single commit, relative to
+    # the repository root
+    if '..' not in commits:
+        commits = '%s^!' % commits
+    with trace.span("git diff", "subprocess"):
+        output = subprocess.check_output(
+            ["git", "diff", "--name-only", "--no-renames", commits, "--"],
+            cwd=path, text=True, stderr=subprocess.DEVNULL)
+    return output.splitlines()
+
+
+def is_ancestor(path, commit, ancestor_of):
+    try:
+        with trace.span("git merge-base", "subprocess"):
+            subprocess.check_call(
+                ["git", "merge-base", "--is-ancestor", commit, ancestor_of],
+                cwd=path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
 
 def get_version(component_path):
     try:
@@ -21,33 +144,75 @@ def get_release(component_path):
     return release
 
 
-def get_makefile_value(makefile, var, env=None):
+def get_changelog_head(changelog):
+    # first non empty line without reading the whole changelog
+    with open(changelog) as fd:
+        for line in fd:
+            if line.strip():
+                return line.strip()
+    return ''
+
+
+class QubesSourceSnapshot:
+    # Metadata of a component source tree (version, rel, debian changelogs
+    # head, files hashes) read once and shared by every parser and dist
+    def __init__(self, path):
+        self.path = path
+        self.version = get_version(path)
+        self.release = get_release(path)
+        self.changelogs = {}
+        self.hashes = {}
+        self.external_inputs = {}
+
+    def get_changelog_head(self, changelog):
+        changelog = os.path.join(self.path, changelog)
+        if changelog not in self.changelogs:
+            self.changelogs[changelog] = get_changelog_head(changelog)
+        return self.changelogs[changelog]
+
+    def get_blob_hash(self, filename):
+        path = os.path.join(self.path, filename)
+        if path not in self.hashes:
+            self.hashes[path] = get_blob_hash(path)
+        return self.hashes[path]
+
+    def has_external_inputs(self, filename, regex):
+        # parse results of such files cannot be cached by their hash
+        path = os.path.join(self.path, filename)
+        if path not in self.external_inputs:
+            self.external_inputs[path] = has_external_inputs(path, regex)
+        return self.external_inputs[path]
+
+
+def get_makefile_value(makefile, var, env=None, src_dir=None):
     # Very simple implementation of getting makefile variables values
     value = ''
     if os.path.exists(makefile):
         curr_dir = os.path.dirname(makefile)
+        if not src_dir:
+            src_dir = os.path.dirname(curr_dir)
         with tempfile.NamedTemporaryFile(dir=curr_dir) as fd:
             content = """
 ORIG_SRC ?= {orig_src}
 ifneq (,$(findstring mgmt-salt-,$(COMPONENT)))
-include $(ORIG_SRC)/../mgmt-salt/Makefile.builder
+include {src_dir}/mgmt-salt/Makefile.builder
 endif
 GITHUB_STATE_DIR = $(HOME)/github-notify-state
 include {makefile}
 
 print-%  : ; @echo $($*)
-""".format(orig_src=os.path.dirname(makefile), makefile=makefile)
+""".format(orig_src=curr_dir, src_dir=src_dir, makefile=makefile)
             fd.write(content.encode('utf-8'))
             fd.seek(0)
-            cmd = "make -f %s print-%s" % (fd.name, var)
-            output = subprocess.check_output([cmd], cwd=curr_dir, shell=True,
-                                             text=True, env=env)
+            cmd = "%s -f %s print-%s" % (MAKE, fd.name, var)
+            with trace.span("make", "subprocess", variable=var):
+                output = subprocess.check_output(
+                    [cmd], cwd=curr_dir, shell=True, text=True, env=env)
             value = output.rstrip('\n')
     return value
 
 
-def get_rpm_spec_files(component_path, dist, package_set):
-    makefile_path = os.path.join(component_path, 'Makefile.builder')
+def get_rpm_env(component_path, dist, package_set):
     env = {
         "COMPONENT": os.path.basename(component_path)
     }
@@ -61,20 +226,127 @@ def get_rpm_spec_files(component_path, dist, package_set):
     elif package_set == 'vm':
         env.update(
             {'PACKAGE_SET': 'vm', 'DISTRIBUTION': distribution, 'DIST': dist})
-
-    specs = get_makefile_value(makefile_path, 'RPM_SPEC_FILES', env)
-    return specs.split()
+    return env
 
 
-def get_deb_control_file(component_path, vm):
-    makefile_path = os.path.join(component_path, 'Makefile.builder')
+def get_deb_env(component_path, vm):
     env = {
         "COMPONENT": os.path.basename(component_path)
     }
     env.update({'PACKAGE_SET': 'vm', 'DISTRIBUTION': 'debian', 'DIST': vm})
-    debian_build_dirs = get_makefile_value(
-        makefile_path, 'DEBIAN_BUILD_DIRS', env)
+    return env
+
+
+def get_deb_control_from_build_dirs(debian_build_dirs):
     control = None
     if debian_build_dirs:
         control = os.path.join(debian_build_dirs, 'control')
     return control
+
+
+MAKEFILE_VALUE_MARKER = '@@qubes-components-manager@@'
+# first line of every environment block of batched make evaluations,
+# undefining variables defined since make started
+MAKEFILE_RESET_VARIABLES = \
+    "$(foreach qcm_variable,$(filter-out $(QCM_BUILTIN_VARIABLES)," \
+    "$(.VARIABLES)),$(eval override undefine $(qcm_variable)))"
+
+
+def evaluate_makefile_values(makefile, variables, env, src_dir=None):
+    # Same as get_makefile_value for several variables without forking make.
+    # Raises MakefileUnsupportedException if makefile needs make itself.
+    curr_dir = os.path.dirname(makefile)
+    if not src_dir:
+        src_dir = os.path.dirname(curr_dir)
+    evaluator = MakefileEvaluator(env, curdir=curr_dir)
+    evaluator.set('ORIG_SRC', curr_dir, '?=')
+    if 'mgmt-salt-' in evaluator.get('COMPONENT'):
+        evaluator.include(
+            os.path.join(src_dir, 'mgmt-salt', 'Makefile.builder'))
+    evaluator.set('GITHUB_STATE_DIR', '$(HOME)/github-notify-state')
+    evaluator.include(makefile)
+    return {var: ' '.join(evaluator.get(var).split()) for var in variables}
+
+
+def get_makefile_values(makefile, variables, envs, src_dir=None,
+                        backend='auto'):
+    # Get values of variables for several environments (typically one per
+    # PACKAGE_SET and DIST). With 'auto' backend, makefile is evaluated in
+    # Python when possible, make is used for the remaining environments.
+    if not os.path.exists(makefile):
+        return [{var: '' for var in variables} for _ in envs]
+    curr_dir = os.path.dirname(makefile)
+    if not src_dir:
+        src_dir = os.path.dirname(curr_dir)
+
+    values = [None] * len(envs)
+    if backend == 'auto':
+        for idx, env in enumerate(envs):
+            try:
+                with trace.span("makefile", "parse", dist=env.get("DIST"),
+                                package_set=env.get("PACKAGE_SET")):
+                    values[idx] = evaluate_makefile_values(
+                        makefile, variables, env, src_dir)
+            except MakefileUnsupportedException:
+                pass
+    missing = [idx for idx, value in enumerate(values) if value is None]
+    if missing:
+        make_values = make_makefile_values(
+            makefile, variables, [envs[idx] for idx in missing], src_dir)
+        for idx, value in zip(missing, make_values):
+            values[idx] = value
+    return values
+
+
+def make_makefile_values(makefile, variables, envs, src_dir):
+    # Single make invocation for all environments: makefile is included
+    # once per environment after undefining every variable defined since
+    # make started, whichever makefile defined it. Falls back to one
+    # get_makefile_value call per variable and environment when this is
+    # not possible.
+    curr_dir = os.path.dirname(makefile)
+    mgmt_salt_makefile = os.path.join(src_dir, 'mgmt-salt', 'Makefile.builder')
+
+    content = "QCM_BUILTIN_VARIABLES := $(.VARIABLES) QCM_BUILTIN_VARIABLES\n"
+    for idx, env in enumerate(envs):
+        content += MAKEFILE_RESET_VARIABLES + "\n"
+        for key, val in env.items():
+            content += "%s := %s\nexport %s\n" % (key, val, key)
+        content += """
+ORIG_SRC ?= {orig_src}
+ifneq (,$(findstring mgmt-salt-,$(COMPONENT)))
+include {mgmt_salt_makefile}
+endif
+GITHUB_STATE_DIR = $(HOME)/github-notify-state
+include {makefile}
+""".format(orig_src=curr_dir, mgmt_salt_makefile=mgmt_salt_makefile,
+           makefile=makefile)
+        for var in variables:
+            content += "$(info %s %d %s $(%s))\n" % (
+                MAKEFILE_VALUE_MARKER, idx, var, var)
+    content += "print: ; @:\n"
+    with tempfile.NamedTemporaryFile(dir=curr_dir) as fd:
+        fd.write(content.encode('utf-8'))
+        fd.seek(0)
+        try:
+            # recipes defined in makefile are overridden at each
+            # inclusion, ignore make warnings about it
+            with trace.span("make", "subprocess", contexts=len(envs)):
+                output = subprocess.check_output(
+                    [MAKE, "-s", "-f", fd.name, "print"], cwd=curr_dir,
+                    text=True, env={}, stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            output = None
+
+    if output is None:
+        return [{var: get_makefile_value(makefile, var, env, src_dir)
+                 for var in variables} for env in envs]
+
+    values = [{var: '' for var in variables} for _ in envs]
+    for line in output.splitlines():
+        if not line.startswith(MAKEFILE_VALUE_MARKER + ' '):
+            continue
+        parsed = line.split(' ', 3)
+        if len(parsed) == 4:
+            values[int(parsed[1])][parsed[2]] = ' '.join(parsed[3].split())
+    return values
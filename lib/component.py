@@ -1,19 +1,36 @@
 import os
+import sys
 import subprocess
 
-from lib.common import get_rpm_spec_files, get_deb_control_file
+from lib import trace
+from lib.common import get_rpm_env, get_deb_env, get_makefile_values, \
+    get_deb_control_from_build_dirs, get_commit, evaluate_makefile_values, \
+    QubesSourceSnapshot, MAKEFILE_EXTERNAL_INPUTS_REGEX, \
+    SPEC_EXTERNAL_INPUTS_REGEX
+from lib.makefile import MakefileUnsupportedException
 from lib.dist import QubesDist
-from lib.rpm_parser import RPMParser
+from lib.rpm_parser import RPMParser, get_default_backend
+from lib.spec_parser import SpecParserUnsupportedException
 from lib.deb_parser import DEBParser
+from lib.worktree import QubesWorktreeException
+
+BUILDER_VARIABLES = ('RPM_SPEC_FILES', 'DEBIAN_BUILD_DIRS')
 
 
 class QubesComponentException(Exception):
     pass
 
 
+# Packages lists hold interned names in tuples and NVRs as (name, version,
+# release, arch) tuples formatted only when requested, so that thousands of
+# components stay cheap in long-lived processes.
 class QubesComponent:
+    __slots__ = ('name', 'orig_src', 'opts', 'releases', 'branch', 'version',
+                 'release', 'raw_packages_list', 'nvr_packages_list',
+                 'commit', 'dists', 'dependencies', 'sources', 'snapshots')
+
     def __init__(self, name, orig_src, **kwargs):
-        self.name = name
+        self.name = sys.intern(name)
         self.orig_src = orig_src
         self.opts = kwargs
 
@@ -23,15 +40,29 @@ class QubesComponent:
         self.release = {}
         self.raw_packages_list = {}
         self.nvr_packages_list = {}
+        # source commit and dists each release packages lists were
+        # computed from
+        self.commit = {}
+        self.dists = {}
+        # build requirements and provides of every release, package set
+        # and dist
+        self.dependencies = {}
+        # spec and control files every release, package set and dist
+        # packages lists are computed from
+        self.sources = {}
+        # (source path, commit) -> QubesSourceSnapshot
+        self.snapshots = {}
 
         # releases is the components/*.json "releases" key
         if "releases" in kwargs:
             for qubes_release, data in kwargs["releases"].items():
+                qubes_release = sys.intern(qubes_release)
                 self.releases.append(qubes_release)
-                self.branch[qubes_release] = data.get("branch", 'master')
+                self.branch[qubes_release] = sys.intern(
+                    data.get("branch", 'master'))
                 self.raw_packages_list[qubes_release] = {
-                    "dom0": data["dom0"],
-                    "vm": data["vm"]
+                    "dom0": intern_dists_lists(data["dom0"]),
+                    "vm": intern_dists_lists(data["vm"])
                 }
             del kwargs["releases"]
 
@@ -58,10 +89,293 @@ class QubesComponent:
         }
         return output
 
+    def to_state_dict(self):
+        releases = {}
+        for qubes_release in self.releases:
+            if qubes_release not in self.commit:
+                continue
+            releases[qubes_release] = {
+                "branch": self.branch[qubes_release],
+                "commit": self.commit[qubes_release],
+                "dists": self.dists[qubes_release],
+                "nvr": self.nvr_packages_list.get(
+                    qubes_release, {"dom0": {}, "vm": {}}),
+                "dependencies": self.dependencies.get(
+                    qubes_release, {"dom0": {}, "vm": {}}),
+                "sources": self.sources.get(
+                    qubes_release, {"dom0": {}, "vm": {}})
+            }
+        return {"releases": releases}
+
+    def get_changes(self, data):
+        # packages gained and lost by every release, package set and dist
+        # compared to data, a components/*.json content
+        old_releases = data.get(self.name, {}).get("releases", {})
+        changes = []
+        for qubes_release in self.releases:
+            new_lists = self.raw_packages_list.get(qubes_release, {})
+            old_lists = old_releases.get(qubes_release, {})
+            for package_set in ("dom0", "vm"):
+                new_dists = new_lists.get(package_set, {})
+                old_dists = old_lists.get(package_set, {})
+                dists = list(new_dists) + [
+                    dist for dist in old_dists if dist not in new_dists]
+                for dist in dists:
+                    new_packages = new_dists.get(dist, [])
+                    old_packages = old_dists.get(dist, [])
+                    added = [pkg for pkg in new_packages
+                             if pkg not in old_packages]
+                    removed = [pkg for pkg in old_packages
+                               if pkg not in new_packages]
+                    if added or removed:
+                        changes.append({
+                            "component": self.name,
+                            "qubes_release": qubes_release,
+                            "package_set": package_set,
+                            "dist": dist,
+                            "added": added,
+                            "removed": removed
+                        })
+        return changes
+
+    def load_state(self, state):
+        for qubes_release, data in state.get("releases", {}).items():
+            # state is outdated if the branch has been changed meanwhile
+            if qubes_release not in self.releases or \
+                    data.get("branch") != self.branch[qubes_release]:
+                continue
+            self.commit[qubes_release] = data.get("commit")
+            self.dists[qubes_release] = {
+                package_set: [sys.intern(dist) for dist in dists]
+                for package_set, dists in data.get("dists", {}).items()}
+            if "nvr" in data:
+                # NVRs are strings in states written before NVR tuples
+                self.nvr_packages_list[qubes_release] = {
+                    sys.intern(package_set): {
+                        sys.intern(dist): tuple(
+                            get_nvr_tuple(nvr) if type(nvr) == list
+                            else sys.intern(nvr) for nvr in nvrs)
+                        for dist, nvrs in dists.items()}
+                    for package_set, dists in data["nvr"].items()}
+            if "dependencies" in data:
+                self.dependencies[qubes_release] = {
+                    sys.intern(package_set): {
+                        sys.intern(dist): {
+                            key: intern_names(names)
+                            for key, names in dependencies.items()}
+                        for dist, dependencies in dists.items()}
+                    for package_set, dists in data["dependencies"].items()}
+            if "sources" in data:
+                self.sources[qubes_release] = {
+                    sys.intern(package_set): intern_dists_lists(dists)
+                    for package_set, dists in data["sources"].items()}
+
+    def is_up_to_date(self, qubes_release, dist_dom0, dists_vm, branch=None):
+        if not branch:
+            branch = self.branch.get(qubes_release, 'master')
+        if branch != self.branch.get(qubes_release):
+            return False
+        dists = {
+            "dom0": [str(dist_dom0)],
+            "vm": [str(dist) for dist in dists_vm]
+        }
+        if dists != self.dists.get(qubes_release):
+            return False
+        # state written before dependencies and sources were recorded
+        if qubes_release not in self.dependencies or \
+                qubes_release not in self.sources:
+            return False
+        commit = get_commit(self.orig_src, branch)
+        return commit is not None and commit == self.commit.get(qubes_release)
+
     def _checkout(self, branch):
         cmd = 'git checkout -q {branch}'.format(branch=branch)
-        subprocess.run(cmd, shell=True, cwd=self.orig_src, check=True,
-                       stderr=subprocess.DEVNULL)
+        with trace.span("git checkout", "subprocess"):
+            subprocess.run(cmd, shell=True, cwd=self.orig_src, check=True,
+                           stderr=subprocess.DEVNULL)
+
+    def _get_source(self, branch, worktrees=None):
+        # returns the path holding the branch content, either a dedicated
+        # worktree or the qubes-src checkout itself, and its commit
+        with trace.span("checkout", branch=branch):
+            if worktrees:
+                try:
+                    return worktrees.acquire(self.orig_src, branch)
+                except QubesWorktreeException:
+                    return None, None
+            try:
+                self._checkout(branch)
+            except subprocess.CalledProcessError:
+                return None, None
+            return self.orig_src, get_commit(self.orig_src, 'HEAD')
+
+    def _get_snapshot(self, src, commit):
+        # releases sharing a branch share the snapshot of its sources
+        if (src, commit) not in self.snapshots:
+            self.snapshots[(src, commit)] = QubesSourceSnapshot(src)
+        return self.snapshots[(src, commit)]
+
+    def _get_makefile_hashes(self, snapshot, src_dir):
+        hashes = [snapshot.get_blob_hash(f)
+                  for f in ('Makefile.builder', 'version', 'rel')]
+        if 'mgmt-salt-' in self.name:
+            hashes.append(snapshot.get_blob_hash(
+                os.path.join(src_dir, 'mgmt-salt', 'Makefile.builder')))
+        return hashes
+
+    def _is_makefile_cacheable(self, snapshot, src_dir):
+        makefiles = ['Makefile.builder']
+        if 'mgmt-salt-' in self.name:
+            makefiles.append(
+                os.path.join(src_dir, 'mgmt-salt', 'Makefile.builder'))
+        return not any(snapshot.has_external_inputs(
+            makefile, MAKEFILE_EXTERNAL_INPUTS_REGEX)
+            for makefile in makefiles)
+
+    @staticmethod
+    def _is_spec_cacheable(snapshot, spec):
+        return not any(snapshot.has_external_inputs(
+            filename, SPEC_EXTERNAL_INPUTS_REGEX)
+            for filename in (spec, spec + '.in'))
+
+    @staticmethod
+    def get_builder_contexts(dist_dom0, dists_vm):
+        return [("dom0", dist_dom0)] + [
+            ("vm", dist) for dist in dists_vm if dist.is_rpm() or dist.is_deb()]
+
+    @staticmethod
+    def get_builder_env(src, package_set, dist):
+        if dist.is_deb():
+            return get_deb_env(src, dist.name)
+        return get_rpm_env(src, dist.name, package_set)
+
+    def _get_builder_values(self, snapshot, src_dir, contexts, cache,
+                            backend='auto', memo=None):
+        # Makefile.builder variables values for every (package set, dist)
+        # context of a release, evaluated at once for uncached contexts
+        src = snapshot.path
+        values = {}
+        missing = []
+        if (cache or memo) and \
+                not self._is_makefile_cacheable(snapshot, src_dir):
+            # values depend on more than the hashed files
+            cache = memo = None
+        hashes = self._get_makefile_hashes(snapshot, src_dir) \
+            if cache or memo else []
+        for package_set, dist in contexts:
+            memo_key = ("makefile-values", self.name, dist.name,
+                        package_set) + tuple(hashes)
+            if memo:
+                try:
+                    values[(package_set, dist.name)] = memo.get(memo_key)
+                    continue
+                except KeyError:
+                    pass
+            if cache:
+                key = cache.get_key("makefile-values", self.name,
+                                    dist.name, package_set, *hashes)
+                try:
+                    values[(package_set, dist.name)] = cache.get(key)
+                    if memo:
+                        memo.set(memo_key, values[(package_set, dist.name)])
+                    continue
+                except KeyError:
+                    pass
+            missing.append((package_set, dist))
+        if not missing:
+            return values
+        envs = [self.get_builder_env(src, package_set, dist)
+                for package_set, dist in missing]
+        makefile = os.path.join(src, 'Makefile.builder')
+        for (package_set, dist), value in zip(missing, get_makefile_values(
+                makefile, BUILDER_VARIABLES, envs, src_dir, backend)):
+            values[(package_set, dist.name)] = value
+            if memo:
+                memo.set(("makefile-values", self.name, dist.name,
+                          package_set) + tuple(hashes), value)
+            if cache:
+                key = cache.get_key("makefile-values", self.name,
+                                    dist.name, package_set, *hashes)
+                cache.set(key, value)
+        return values
+
+    @staticmethod
+    def _get_rpm_packages(snapshot, spec, dist, package_set, cache,
+                          backend='auto', memo=None):
+        with trace.span("packages", dist=dist.name, package_set=package_set):
+            rpm_parser = RPMParser(
+                snapshot.path, spec, dist, backend, snapshot, memo)
+            if not cache or not QubesComponent._is_spec_cacheable(
+                    snapshot, spec):
+                return rpm_parser.get_packages()
+            key = cache.get_key(
+                "rpm-packages", dist.name, package_set,
+                *[snapshot.get_blob_hash(f)
+                  for f in (spec, spec + '.in', 'version', 'rel')])
+            try:
+                return cache.get(key)
+            except KeyError:
+                pass
+            packages = rpm_parser.get_packages()
+            cache.set(key, packages)
+            return packages
+
+    @staticmethod
+    def _get_rpm_dependencies(snapshot, spec, dist, cache, backend='auto',
+                              memo=None):
+        rpm_parser = RPMParser(snapshot.path, spec, dist, backend, snapshot,
+                               memo)
+        if not cache or not QubesComponent._is_spec_cacheable(
+                snapshot, spec):
+            return rpm_parser.get_dependencies()
+        key = cache.get_key(
+            "rpm-dependencies", dist.name,
+            *[snapshot.get_blob_hash(f)
+              for f in (spec, spec + '.in', 'version', 'rel')])
+        try:
+            return cache.get(key)
+        except KeyError:
+            pass
+        dependencies = rpm_parser.get_dependencies()
+        cache.set(key, dependencies)
+        return dependencies
+
+    @staticmethod
+    def _get_deb_dependencies(snapshot, control, cache):
+        deb_parser = DEBParser(snapshot.path, control, snapshot)
+        if not cache:
+            return deb_parser.get_dependencies()
+        changelog = os.path.join(os.path.dirname(control), 'changelog')
+        key = cache.get_key(
+            "deb-dependencies",
+            *[snapshot.get_blob_hash(f)
+              for f in (control, changelog, 'version', 'rel')])
+        try:
+            return cache.get(key)
+        except KeyError:
+            pass
+        dependencies = deb_parser.get_dependencies()
+        cache.set(key, dependencies)
+        return dependencies
+
+    @staticmethod
+    def _get_deb_packages(snapshot, control, dist, cache):
+        with trace.span("packages", dist=dist, package_set="vm"):
+            deb_parser = DEBParser(snapshot.path, control, snapshot)
+            if not cache:
+                return deb_parser.get_packages()
+            changelog = os.path.join(os.path.dirname(control), 'changelog')
+            key = cache.get_key(
+                "deb-packages", dist,
+                *[snapshot.get_blob_hash(f)
+                  for f in (control, changelog, 'version', 'rel')])
+            try:
+                return cache.get(key)
+            except KeyError:
+                pass
+            packages = deb_parser.get_packages()
+            cache.set(key, packages)
+            return packages
 
     def get_maintainers(self):
         return self.opts.get('maintainers', [])
@@ -81,7 +395,8 @@ class QubesComponent:
                 name=name, version=version, release=release, arch=arch)
         return rpm
 
-    def get_nvr_deb(self, dist, name, version, release, arch, update=1):
+    @staticmethod
+    def get_nvr_deb(dist, name, version, release, arch, update=1):
         debian_ver = dist.get_version()
         if release:
             deb = "{name}_{version}-{release}+deb{debian_ver}u{update}_{arch}.deb".format(
@@ -93,68 +408,299 @@ class QubesComponent:
                 arch=arch, update=update)
         return deb
 
-    def update(self, qubes_release, dist_dom0, dists_vm, branch=None):
+    def compare_builder_values(self, qubes_release, dist_dom0, dists_vm,
+                               worktrees=None):
+        # differential check between Python and make evaluations of
+        # Makefile.builder, returns the differences and the contexts
+        # not supported by Python evaluation
+        branch = self.branch.get(qubes_release, 'master')
+        src, _ = self._get_source(branch, worktrees)
+        if not src:
+            return [], []
+        src_dir = os.path.dirname(self.orig_src)
+        makefile = os.path.join(src, 'Makefile.builder')
+        if not os.path.exists(makefile):
+            return [], []
+        if type(dist_dom0) == str:
+            dist_dom0 = QubesDist(dist_dom0)
+        dists_vm = [QubesDist(dist) if type(dist) == str else dist
+                    for dist in dists_vm]
+        differences = []
+        unsupported = []
+        for package_set, dist in self.get_builder_contexts(
+                dist_dom0, dists_vm):
+            env = self.get_builder_env(src, package_set, dist)
+            make_values = get_makefile_values(
+                makefile, BUILDER_VARIABLES, [env], src_dir, 'make')[0]
+            try:
+                python_values = evaluate_makefile_values(
+                    makefile, BUILDER_VARIABLES, env, src_dir)
+            except MakefileUnsupportedException as e:
+                unsupported.append((package_set, dist.name, str(e)))
+                continue
+            for var in BUILDER_VARIABLES:
+                if python_values[var] != make_values[var]:
+                    differences.append((package_set, dist.name, var,
+                                        python_values[var], make_values[var]))
+        return differences, unsupported
+
+    def compare_spec_packages(self, qubes_release, dist_dom0, dists_vm,
+                              worktrees=None, backend=None):
+        # differential check between native spec parser and rpm, returns
+        # the differences and the specs not supported by the native parser
+        branch = self.branch.get(qubes_release, 'master')
+        src, _ = self._get_source(branch, worktrees)
+        if not src:
+            return [], []
+        src_dir = os.path.dirname(self.orig_src)
+        if not backend or backend == 'auto':
+            backend = get_default_backend()
+        if type(dist_dom0) == str:
+            dist_dom0 = QubesDist(dist_dom0)
+        dists_vm = [QubesDist(dist) if type(dist) == str else dist
+                    for dist in dists_vm]
+        contexts = [(package_set, dist) for package_set, dist in
+                    self.get_builder_contexts(dist_dom0, dists_vm)
+                    if dist.is_rpm()]
+        snapshot = QubesSourceSnapshot(src)
+        builder_values = self._get_builder_values(
+            snapshot, src_dir, contexts, None)
+        differences = []
+        unsupported = []
+        for package_set, dist in contexts:
+            for spec in builder_values[(package_set, dist.name)][
+                    "RPM_SPEC_FILES"].split():
+                filespec = os.path.join(src, spec)
+                if os.path.exists(filespec + '.in'):
+                    filespec += '.in'
+                if not os.path.exists(filespec):
+                    continue
+                rpm_parser = RPMParser(src, spec, dist, backend, snapshot)
+                with open(filespec) as fd:
+                    content = rpm_parser.get_rendered_spec(fd.read().strip())
+                try:
+                    native_packages = rpm_parser.query_native(content)
+                except SpecParserUnsupportedException as e:
+                    unsupported.append((package_set, dist.name, spec, str(e)))
+                    continue
+                rpm_packages = rpm_parser.get_raw_infos(filespec)
+                if native_packages != rpm_packages:
+                    differences.append((package_set, dist.name, spec,
+                                        native_packages, rpm_packages))
+        return differences, unsupported
+
+    def update(self, qubes_release, dist_dom0, dists_vm, branch=None,
+               worktrees=None, cache=None, makefile_backend='auto',
+               rpm_backend='auto', dists=None, from_checkout=False,
+               memo=None):
+        # With dists, only the packages lists of these dists are evaluated
+        # again. With from_checkout, qubes-src content is used as is
+        # (e.g. with uncommitted changes) without checking out the branch.
+        with trace.span("update", component=self.name,
+                        release=qubes_release):
+            self._update(qubes_release, dist_dom0, dists_vm, branch,
+                         worktrees, cache, makefile_backend, rpm_backend,
+                         dists, from_checkout, memo)
+
+    def _update(self, qubes_release, dist_dom0, dists_vm, branch, worktrees,
+                cache, makefile_backend, rpm_backend, dists, from_checkout,
+                memo):
         if not branch:
             branch = self.branch.get(qubes_release, 'master')
-        try:
-            self._checkout(branch)
-        except subprocess.CalledProcessError:
+        if from_checkout:
+            src, commit = self.orig_src, None
+            # content may have changed since last evaluation
+            self.snapshots.pop((src, commit), None)
+        else:
+            src, commit = self._get_source(branch, worktrees)
+        if not src:
             return
+        src_dir = os.path.dirname(self.orig_src)
         self.branch[qubes_release] = branch
 
-        self.raw_packages_list[qubes_release] = {"dom0": {}, "vm": {}}
-        self.nvr_packages_list[qubes_release] = {"dom0": {}, "vm": {}}
+        if dists is None or qubes_release not in self.raw_packages_list:
+            dists = None
+            self.raw_packages_list[qubes_release] = {"dom0": {}, "vm": {}}
+        if dists is None or qubes_release not in self.nvr_packages_list:
+            self.nvr_packages_list[qubes_release] = {"dom0": {}, "vm": {}}
+        if dists is None or qubes_release not in self.dependencies:
+            self.dependencies[qubes_release] = {"dom0": {}, "vm": {}}
+        if dists is None or qubes_release not in self.sources:
+            self.sources[qubes_release] = {"dom0": {}, "vm": {}}
+
+        if type(dist_dom0) == str:
+            dist_dom0 = QubesDist(dist_dom0)
+        dists_vm = [QubesDist(dist) if type(dist) == str else dist
+                    for dist in dists_vm]
+        self.commit[qubes_release] = commit
+        self.dists[qubes_release] = {
+            "dom0": [dist_dom0.name],
+            "vm": [dist.name for dist in dists_vm]
+        }
 
         if self.name == "linux-template-builder":
             return
 
+        contexts = [(package_set, dist) for package_set, dist in
+                    self.get_builder_contexts(dist_dom0, dists_vm)
+                    if dists is None or dist.name in dists]
+        snapshot = self._get_snapshot(src, commit)
+        builder_values = self._get_builder_values(
+            snapshot, src_dir, contexts, cache, makefile_backend, memo)
+
         # dom0
-        if type(dist_dom0) == str:
-            dist_dom0 = QubesDist(dist_dom0)
-        packages_list = []
-        specs = get_rpm_spec_files(self.orig_src, dist_dom0.name, "dom0")
-        for spec in specs:
-            rpm_parser = RPMParser(self.orig_src, spec)
-            packages_list += rpm_parser.get_packages()
-        self.raw_packages_list[qubes_release]["dom0"][dist_dom0.name] = []
-        self.nvr_packages_list[qubes_release]["dom0"][dist_dom0.name] = []
-        for pkg in packages_list:
-            self.raw_packages_list[qubes_release]["dom0"][dist_dom0.name].append(pkg['name'])
-            nvr_pkg = self.get_nvr_rpm(pkg['name'], pkg["version"], pkg["release"], pkg['arch'][0])
-            self.nvr_packages_list[qubes_release]["dom0"][dist_dom0.name].append(nvr_pkg)
+        if dists is None or dist_dom0.name in dists:
+            packages_list = []
+            dependencies = []
+            specs = builder_values[
+                ("dom0", dist_dom0.name)]["RPM_SPEC_FILES"].split()
+            for spec in specs:
+                packages_list += self._get_rpm_packages(
+                    snapshot, spec, dist_dom0, "dom0", cache, rpm_backend,
+                    memo)
+                dependencies.append(self._get_rpm_dependencies(
+                    snapshot, spec, dist_dom0, cache, rpm_backend, memo))
+            self._set_packages_list(qubes_release, "dom0", dist_dom0,
+                                    packages_list, dependencies, specs)
 
         # vm
         for dist in dists_vm:
+            if dists is not None and dist.name not in dists:
+                continue
             packages_list = []
-            if type(dist) == str:
-                dist = QubesDist(dist)
+            dependencies = []
+            sources = []
             if dist.is_rpm():
-                specs = get_rpm_spec_files(self.orig_src, dist.name, "vm")
+                specs = builder_values[("vm", dist.name)][
+                    "RPM_SPEC_FILES"].split()
                 for spec in specs:
-                    rpm_parser = RPMParser(self.orig_src, spec)
-                    packages_list += rpm_parser.get_packages()
+                    packages_list += self._get_rpm_packages(
+                        snapshot, spec, dist, "vm", cache, rpm_backend,
+                        memo)
+                    dependencies.append(self._get_rpm_dependencies(
+                        snapshot, spec, dist, cache, rpm_backend, memo))
+                sources = specs
             elif dist.is_deb():
-                control = get_deb_control_file(self.orig_src, dist.name)
+                control = get_deb_control_from_build_dirs(
+                    builder_values[("vm", dist.name)]["DEBIAN_BUILD_DIRS"])
                 if control:
-                    control = os.path.join(self.orig_src, control)
-                    deb_parser = DEBParser(self.orig_src, control)
-                    packages_list = deb_parser.get_packages()
-            self.raw_packages_list[qubes_release]["vm"][dist.name] = []
-            self.nvr_packages_list[qubes_release]["vm"][dist.name] = []
-            for pkg in packages_list:
-                self.raw_packages_list[qubes_release]["vm"][dist.name].append(pkg['name'])
-                if dist.is_rpm():
-                    nvr_pkg = self.get_nvr_rpm(pkg['name'], pkg["version"], pkg["release"], pkg['arch'][0])
-                elif dist.is_deb():
-                    nvr_pkg = self.get_nvr_deb(dist, pkg['name'], pkg["version"], pkg["release"], pkg['arch'][0])
-                else:
-                    continue
-                self.nvr_packages_list[qubes_release]["vm"][dist.name].append(nvr_pkg)
+                    sources = [control]
+                    control = os.path.join(src, control)
+                    packages_list = self._get_deb_packages(
+                        snapshot, control, dist.name, cache)
+                    dependencies.append(self._get_deb_dependencies(
+                        snapshot, control, cache))
+            self._set_packages_list(qubes_release, "vm", dist, packages_list,
+                                    dependencies, sources)
+
+    def _set_packages_list(self, qubes_release, package_set, dist,
+                           packages_list, dependencies=None, sources=None):
+        # dependencies of every spec or control file, None for missing ones
+        self.sources[qubes_release][package_set][dist.name] = intern_names(
+            os.path.normpath(source) for source in sources or [])
+        build_requires = []
+        provides = []
+        for spec_dependencies in dependencies or []:
+            if spec_dependencies:
+                build_requires += spec_dependencies["build_requires"]
+                provides += spec_dependencies["provides"]
+        self.dependencies[qubes_release][package_set][dist.name] = {
+            "build_requires": intern_names(dict.fromkeys(build_requires)),
+            "provides": intern_names(dict.fromkeys(provides))
+        }
+        self.raw_packages_list[qubes_release][package_set][dist.name] = \
+            intern_names(pkg['name'] for pkg in packages_list)
+        nvr_packages_list = []
+        if dist.is_rpm() or dist.is_deb():
+            nvr_packages_list = [
+                get_nvr_tuple([pkg['name'], pkg["version"], pkg["release"],
+                               pkg['arch'][0]]) for pkg in packages_list]
+        self.nvr_packages_list[qubes_release][package_set][dist.name] = \
+            tuple(nvr_packages_list)
+
+    def get_nvr(self, dist, nvr):
+        # built file name of a (name, version, release, arch) NVR
+        if type(nvr) == str:
+            return nvr
+        if dist.is_rpm():
+            return self.get_nvr_rpm(*nvr)
+        return self.get_nvr_deb(dist, *nvr)
 
     def get_nvr_packages_list(self, qubes_release):
-        packages_list = self.nvr_packages_list[qubes_release]
-        return packages_list
+        # None if never computed for this release
+        packages_list = self.nvr_packages_list.get(qubes_release)
+        if packages_list is None:
+            return None
+        return {
+            package_set: {
+                dist: [self.get_nvr(QubesDist(dist), nvr) for nvr in nvrs]
+                for dist, nvrs in dists.items()}
+            for package_set, dists in packages_list.items()}
 
     def get_packages_list(self, qubes_release):
         packages_list = self.raw_packages_list[qubes_release]
         return packages_list
+
+    def get_dependencies(self, qubes_release):
+        # None if never computed for this release
+        return self.dependencies.get(qubes_release)
+
+    def get_affected_dists(self, qubes_release, dists, filenames):
+        # dists of the release among dists (package set -> dists names)
+        # whose packages lists or NVRs depend on the changed files,
+        # relative to the component sources
+        sources = self.sources.get(qubes_release)
+        if any(filename in ('Makefile.builder', 'version', 'rel')
+               for filename in filenames):
+            # spec and control files resolution or versions change
+            return {package_set: list(names)
+                    for package_set, names in dists.items()}
+        affected = {}
+        for package_set, names in dists.items():
+            affected[package_set] = []
+            for dist in names:
+                if sources is None:
+                    # state written before sources were recorded
+                    dist_sources = None
+                else:
+                    dist_sources = sources.get(package_set, {}).get(dist, [])
+                if is_source_changed(dist_sources, filenames):
+                    affected[package_set].append(dist)
+        return affected
+
+
+def is_source_changed(sources, filenames):
+    # sources are spec or control files, None if unknown
+    if sources is None:
+        return any(is_source_file(filename) for filename in filenames)
+    for source in sources:
+        if os.path.basename(source) == 'control':
+            changed = [os.path.join(os.path.dirname(source), filename)
+                       for filename in ('control', 'changelog')]
+        else:
+            changed = [source, source + '.in']
+        if any(filename in changed for filename in filenames):
+            return True
+    return False
+
+
+def is_source_file(filename):
+    basename = os.path.basename(filename)
+    return basename in ('control', 'changelog') or \
+        basename.endswith('.spec') or basename.endswith('.spec.in')
+
+
+def intern_names(names):
+    return tuple(sys.intern(name) for name in names)
+
+
+def intern_dists_lists(dists):
+    # dist -> names, None lists are kept
+    return {sys.intern(dist): intern_names(names) if names is not None
+            else None for dist, names in dists.items()}
+
+
+def get_nvr_tuple(nvr):
+    # (name, version, release, arch) sharing strings with other packages
+    return tuple(sys.intern(value) if type(value) == str else value
+                 for value in nvr)
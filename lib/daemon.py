@@ -0,0 +1,68 @@
+import os
+import json
+import socket
+import socketserver
+
+
+class QubesDaemonException(Exception):
+    pass
+
+
+# Requests and responses are single line JSON objects. Requests are handled
+# one at a time so that the handler may use process wide state (stdout,
+# logging handlers).
+class QubesDaemon(socketserver.UnixStreamServer):
+    def __init__(self, socket_path, handler):
+        self.socket_path = os.path.abspath(socket_path)
+        self.handler = handler
+        if os.path.exists(self.socket_path):
+            try:
+                send_request(self.socket_path, {"ping": True})
+            except (OSError, QubesDaemonException):
+                # stale socket of a daemon which did not exit properly
+                os.remove(self.socket_path)
+            else:
+                raise QubesDaemonException(
+                    "A daemon is already listening on %s" % self.socket_path)
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        umask = os.umask(0o077)
+        try:
+            super().__init__(self.socket_path, QubesDaemonRequestHandler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class QubesDaemonRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError:
+            response = {"error": "Invalid request"}
+        else:
+            if request.get("ping"):
+                response = {"pong": True}
+            else:
+                response = self.server.handler(request)
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+def send_request(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as fd:
+            line = fd.readline()
+    if not line:
+        raise QubesDaemonException("No response from %s" % socket_path)
+    try:
+        return json.loads(line)
+    except ValueError:
+        raise QubesDaemonException("Invalid response from %s" % socket_path)
@@ -1,26 +1,41 @@
 import os
 import re
 
-from lib.common import get_version, get_release
+from lib import trace
+from lib.common import QubesSourceSnapshot
 
 
 class DEBParserException(Exception):
     pass
 
 
+def get_relations_names(value):
+    # 'a (>= 1.0) [amd64], b:any | c, ${misc:Depends}' -> ['a', 'b'], only
+    # the first alternative being used for building like sbuild does
+    names = []
+    for relation in value.split(','):
+        relation = relation.split('|')[0].strip()
+        if not relation or relation.startswith('$'):
+            continue
+        name = re.split(r'[\s(\[<]', relation, 1)[0].split(':')[0]
+        if name:
+            names.append(name)
+    return names
+
+
 class DEBParser:
 
-    def __init__(self, orig_src, control):
+    def __init__(self, orig_src, control, snapshot=None):
         self.orig_src = orig_src
         self.control = os.path.join(orig_src, control)
+        self.snapshot = snapshot or QubesSourceSnapshot(orig_src)
         self.packages = []
+        self.verrel = None
 
     def get_verrel_from_changelog(self):
         # python-hid is in this case
         changelog = os.path.join(os.path.dirname(self.control), 'changelog')
-        with open(changelog, "r") as fd:
-            content = fd.read().strip()
-        first_line = content.split('\n')[0]
+        first_line = self.snapshot.get_changelog_head(changelog)
         if re.match('.*\((.*)\).*', first_line):
             verrel = re.match('.*\((.*)\).*', first_line).group(1)
         else:
@@ -34,15 +49,16 @@ class DEBParser:
 
     def parse(self):
         if os.path.exists(self.control):
-            with open(self.control, "r") as fd:
-                content = fd.read().strip()
-            packages = content.split("\n\n")
-            if packages[0]:
-                raw_pkg_info = [self.get_raw_info(pkg) for pkg in packages]
-                for pkg in raw_pkg_info:
-                    pkg_info = self.get_info(pkg)
-                    if pkg_info:
-                        self.packages.append(pkg_info)
+            with trace.span("control", "parse"):
+                with open(self.control, "r") as fd:
+                    content = fd.read().strip()
+                packages = content.split("\n\n")
+                if packages[0]:
+                    raw_pkg_info = [self.get_raw_info(pkg) for pkg in packages]
+                    for pkg in raw_pkg_info:
+                        pkg_info = self.get_info(pkg)
+                        if pkg_info:
+                            self.packages.append(pkg_info)
 
     @staticmethod
     def get_raw_info(text):
@@ -54,20 +70,27 @@ class DEBParser:
             pkg_details = dict(zip(keys, values))
             return pkg_details
 
+    def get_verrel(self):
+        # same for every package of the control file
+        if not self.verrel:
+            version = self.snapshot.version
+            release = self.snapshot.release
+            verrel = self.get_verrel_from_changelog()
+            if not version or not release:
+                verrel = verrel.split('-')
+                version = verrel[0]
+                # linux-utils does not have release
+                if len(verrel) == 2:
+                    release = verrel[1]
+            self.verrel = (version, release)
+        return self.verrel
+
     def get_info(self, raw_info, filtered_arches=None):
         pkg = None
         name = raw_info.get("package")
         arch = raw_info.get("architecture")
 
-        version = get_version(self.orig_src)
-        release = get_release(self.orig_src)
-        verrel = self.get_verrel_from_changelog()
-        if not version or not release:
-            verrel = verrel.split('-')
-            version = verrel[0]
-            # linux-utils does not have release
-            if len(verrel) == 2:
-                release = verrel[1]
+        version, release = self.get_verrel()
 
         if name and arch:
             arch = arch.split()
@@ -84,3 +107,32 @@ class DEBParser:
                     "arch": available_arches
                 }
             return pkg
+
+    def get_dependencies(self):
+        # names needed for building the source package and names provided
+        # by its binary packages, None if there is no control file
+        if not os.path.exists(self.control):
+            return None
+        with trace.span("control dependencies", "parse"):
+            with open(self.control, "r") as fd:
+                content = fd.read().strip()
+            # comments are not part of fields values
+            content = re.sub(r"^#.*\n?", "", content, flags=re.MULTILINE)
+            stanzas = [self.get_raw_info(stanza)
+                       for stanza in content.split("\n\n")]
+            stanzas = [stanza for stanza in stanzas if stanza]
+            build_requires = []
+            provides = []
+            for stanza in stanzas:
+                if "source" in stanza:
+                    for field in ("build-depends", "build-depends-indep",
+                                  "build-depends-arch"):
+                        build_requires += get_relations_names(
+                            stanza.get(field, ''))
+                elif self.get_info(stanza):
+                    provides += get_relations_names(
+                        stanza.get("provides", ''))
+        return {
+            "build_requires": list(dict.fromkeys(build_requires)),
+            "provides": list(dict.fromkeys(provides))
+        }
@@ -1,3 +1,6 @@
+import sys
+import subprocess
+
 DEBIAN = {
     "stretch": "debian-9",
     "buster": "debian-10",
@@ -12,9 +15,47 @@ WHONIX = {
 }
 
 
+RPM = "rpm"
+
+# dist macros defined by the host rpm configuration (e.g. 'fc38' or 'el8'),
+# evaluated once
+HOST_CONTEXT = {"dist_macros": None}
+
+
+def get_host_dist_macros():
+    if HOST_CONTEXT["dist_macros"] is None:
+        try:
+            output = subprocess.check_output(
+                [RPM, "--eval", "%{?fedora}:%{?rhel}"], text=True,
+                stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, OSError):
+            output = ':'
+        fedora, _, rhel = output.strip().partition(':')
+        macros = set()
+        if fedora:
+            macros.add("fc%s" % fedora)
+        if rhel:
+            macros.add("el%s" % rhel)
+        HOST_CONTEXT["dist_macros"] = macros
+    return HOST_CONTEXT["dist_macros"]
+
+
+# Flyweight: QubesDist(name) always returns the same instance for a given
+# name, shared by every release and component
 class QubesDist:
-    def __init__(self, name):
-        self.name = name
+    __slots__ = ('name',)
+    instances = {}
+
+    def __new__(cls, name):
+        dist = cls.instances.get(name)
+        if dist is None:
+            dist = super().__new__(cls)
+            dist.name = sys.intern(name)
+            dist = cls.instances.setdefault(dist.name, dist)
+        return dist
+
+    def __getnewargs__(self):
+        return (self.name,)
 
     def __repr__(self):
         return self.__str__()
@@ -36,6 +77,33 @@ class QubesDist:
         elif self.is_deb():
             return DEBIAN[self.name].split('-')[1]
 
+    def get_rpm_macros(self):
+        # macros defining the dist context of spec files, None means the
+        # macro has to be undefined (e.g. host ones)
+        if not self.is_rpm():
+            return {}
+        version = self.get_version()
+        if self.name.startswith("fc"):
+            macros = {
+                "dist": ".fc%s" % version,
+                "fedora": version,
+                "fc%s" % version: "1",
+                "rhel": None,
+                "centos": None,
+            }
+        else:
+            macros = {
+                "dist": ".el%s" % version,
+                "rhel": version,
+                "centos": version,
+                "el%s" % version: "1",
+                "fedora": None,
+            }
+        # e.g. %{?fc38} of a fc38 host when parsing for fc32
+        for name in get_host_dist_macros():
+            macros.setdefault(name, None)
+        return macros
+
     def get_labels(self):
         labels = []
         label = None
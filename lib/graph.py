@@ -0,0 +1,97 @@
+# Build order of components from their build dependencies. Nodes are
+# components names and edges map a component to the components it build
+# depends on.
+
+
+def get_cycles(nodes, edges):
+    # strongly connected components of more than one node (Tarjan), nodes
+    # of every cycle in the order of nodes
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+    counter = 0
+    for root in nodes:
+        if root in index:
+            continue
+        # iterative depth first search: (node, iterator on its edges)
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(edges.get(root, ())))]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = counter
+                    counter += 1
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append(
+                        (successor, iter(edges.get(successor, ()))))
+                    break
+                if successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.add(member)
+                        if member == node:
+                            break
+                    if len(component) > 1:
+                        cycles.append(
+                            [name for name in nodes if name in component])
+    order = {name: idx for idx, name in enumerate(nodes)}
+    return sorted(cycles, key=lambda cycle: order[cycle[0]])
+
+
+def get_build_waves(nodes, edges):
+    # lists of components of which every one only depends on components of
+    # previous lists, and cycles. Components of a cycle are put in the same
+    # wave, in which they have to be built in nodes order.
+    cycles = get_cycles(nodes, edges)
+    group = {name: (name,) for name in nodes}
+    for cycle in cycles:
+        for name in cycle:
+            group[name] = tuple(cycle)
+
+    wave = {}
+    for name in nodes:
+        if group[name] in wave:
+            continue
+        # wave of a group is one more than the highest wave of the groups
+        # it depends on
+        work = [group[name]]
+        while work:
+            current = work[-1]
+            pending = []
+            highest = -1
+            for member in current:
+                for dependency in edges.get(member, ()):
+                    dependency_group = group.get(dependency)
+                    if dependency_group is None or \
+                            dependency_group == current:
+                        continue
+                    if dependency_group in wave:
+                        highest = max(highest, wave[dependency_group])
+                    else:
+                        pending.append(dependency_group)
+            if pending:
+                work += pending
+                continue
+            work.pop()
+            wave[current] = highest + 1
+
+    waves = [[] for _ in range(max(wave.values(), default=-1) + 1)]
+    for name in nodes:
+        waves[wave[group[name]]].append(name)
+    return waves, cycles
@@ -0,0 +1,162 @@
+import os
+import re
+import pickle
+import tempfile
+
+from lib.dist import QubesDist
+
+# bump when the layout of indexed data changes
+INDEX_VERSION = 2
+
+
+def get_stamp(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+# Single file holding everything read at startup (release file, components
+# files and states). It is valid as long as none of the recorded inputs
+# has been replaced, resized or modified since it has been written.
+class QubesComponentsIndex:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.stamps = {}
+
+    def add_input(self, path):
+        # to be called before reading path so that a concurrent change
+        # invalidates the index
+        self.stamps[os.path.abspath(path)] = get_stamp(path)
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as fd:
+                index = pickle.load(fd)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if not isinstance(index, dict) or \
+                index.get("version") != INDEX_VERSION:
+            return None
+        for path, stamp in index["stamps"].items():
+            if get_stamp(path) != stamp:
+                return None
+        return index["data"]
+
+    def save(self, data):
+        index = {
+            "version": INDEX_VERSION,
+            "stamps": self.stamps,
+            "data": data
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                'wb', dir=os.path.dirname(self.path), delete=False) as fd:
+            pickle.dump(index, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fd.name, self.path)
+
+
+def get_package_name(filename):
+    # name-version-release.arch.rpm or name_version-release_arch.deb
+    if filename.endswith('.deb'):
+        return filename.split('_')[0]
+    if filename.endswith('.rpm'):
+        return filename[:-len('.rpm')].rsplit('.', 1)[0].rsplit('-', 2)[0]
+    return filename
+
+
+def get_package_kind(filename):
+    # 'rpm', 'deb' or None for a package name
+    for kind in ('rpm', 'deb'):
+        if filename.endswith('.%s' % kind):
+            return kind
+    return None
+
+
+DIST_TAG_REGEX = re.compile(r'(\.fc\d+|\.el\d+|\+deb\d+)(?=[._u])')
+
+
+def get_file_dist_tag(filename):
+    # '.fc32', '.el8' or '+deb11' of a built file, None without dist tag
+    match = DIST_TAG_REGEX.search(filename)
+    return match.group(1) if match else None
+
+
+def get_dist_tag(dist):
+    if dist.is_rpm():
+        return dist.get_rpm_macros()["dist"]
+    return "+deb%s" % dist.get_version()
+
+
+# Package names and built files names mapped to the components, releases
+# and dists producing them.
+class QubesReverseIndex:
+    def __init__(self):
+        self.entries = {}
+        # (package name, 'rpm' or 'deb') -> entries, for built files of
+        # another version than the recorded one
+        self.packages = {}
+
+    @staticmethod
+    def get_entry(component, qubes_release, package_set, dist):
+        return {
+            "component": component,
+            "qubes_release": qubes_release,
+            "package_set": package_set,
+            "dist": dist
+        }
+
+    def add(self, key, component, qubes_release, package_set, dist):
+        self.entries.setdefault(key, []).append(self.get_entry(
+            component, qubes_release, package_set, dist))
+
+    def add_package(self, name, kind, component, qubes_release, package_set,
+                    dist):
+        self.packages.setdefault((name, kind), []).append(self.get_entry(
+            component, qubes_release, package_set, dist))
+
+    @classmethod
+    def from_components(cls, components):
+        index = cls()
+        for component in components:
+            for qubes_release in component.releases:
+                packages_list = component.get_packages_list(qubes_release)
+                for names_list in (
+                        packages_list,
+                        component.get_nvr_packages_list(qubes_release)):
+                    if not names_list:
+                        continue
+                    for package_set, dists in names_list.items():
+                        for dist, names in dists.items():
+                            for name in names or []:
+                                index.add(name, component.name,
+                                          qubes_release, package_set, dist)
+                for package_set, dists in (packages_list or {}).items():
+                    for dist, packages in dists.items():
+                        if QubesDist(dist).is_rpm():
+                            kind = 'rpm'
+                        elif QubesDist(dist).is_deb():
+                            kind = 'deb'
+                        else:
+                            continue
+                        for package in packages or []:
+                            index.add_package(
+                                package, kind, component.name,
+                                qubes_release, package_set, dist)
+        return index
+
+    def lookup(self, name):
+        entries = self.entries.get(name)
+        if entries is None:
+            # built file from another version than the recorded one, only
+            # matching dists building this kind of packages for its dist
+            kind = get_package_kind(name)
+            if not kind:
+                return []
+            entries = self.packages.get((get_package_name(name), kind), [])
+            dist_tag = get_file_dist_tag(name)
+            if dist_tag:
+                entries = [entry for entry in entries if get_dist_tag(
+                    QubesDist(entry["dist"])) == dist_tag]
+        return entries
@@ -0,0 +1,445 @@
+import os
+import re
+import glob
+
+
+class MakefileUnsupportedException(Exception):
+    pass
+
+
+ASSIGNMENT_REGEX = re.compile(
+    r"^((?:override|export)\s+)*([^\s:#=?+!$()]+)\s*(::?=|:::=|\?=|\+=|!=|=)(.*)$")
+# any assignment, including the ones with computed variable names
+ANY_ASSIGNMENT_REGEX = re.compile(r"^[^:=#]*(?::{1,3}=|[?+!]?=)")
+CONDITIONAL_DIRECTIVES = ("ifeq", "ifneq", "ifdef", "ifndef")
+
+
+def split_rule(line):
+    # (targets, rest) at the first colon outside of variables references,
+    # rest is None without such colon
+    depth = 0
+    for idx, char in enumerate(line):
+        if char in '({':
+            depth += 1
+        elif char in ')}':
+            depth = max(depth - 1, 0)
+        elif char == ':' and not depth:
+            return line[:idx], line[idx + 1:].lstrip(':')
+    return line, None
+
+
+# Evaluator for the subset of GNU make used by most Makefile.builder files:
+# variables assignments and conditionals on them. Anything else, which would
+# need make itself to be evaluated, raises MakefileUnsupportedException.
+class MakefileEvaluator:
+    def __init__(self, env=None, curdir=None):
+        self.curdir = curdir or os.getcwd()
+        # name -> (recursive, value)
+        self.variables = {
+            "CURDIR": (False, self.curdir),
+            "SHELL": (False, "/bin/sh"),
+        }
+        for key, val in (env or {}).items():
+            self.variables[key] = (True, val)
+        # (expanded targets, assignment) of target-specific variables,
+        # kept unevaluated as they do not change global values
+        self.target_variables = []
+
+    def set(self, name, value, operator='='):
+        if operator in ('=', '?='):
+            if operator == '?=' and name in self.variables:
+                return
+            self.variables[name] = (True, value)
+        elif operator in (':=', '::=', ':::='):
+            self.variables[name] = (False, self.expand(value))
+        elif operator == '+=':
+            if name not in self.variables:
+                self.variables[name] = (True, value)
+                return
+            recursive, current = self.variables[name]
+            if not recursive:
+                value = self.expand(value)
+            self.variables[name] = (
+                recursive, (current + ' ' + value) if current else value)
+        else:
+            raise MakefileUnsupportedException(
+                "Unsupported assignment '%s'" % operator)
+
+    def get(self, name):
+        recursive, value = self.variables.get(name, (False, ''))
+        if recursive:
+            return self.expand(value)
+        return value
+
+    @staticmethod
+    def _find_closing(text, start, opening, closing):
+        depth = 0
+        for idx in range(start, len(text)):
+            if text[idx] == opening:
+                depth += 1
+            elif text[idx] == closing:
+                if depth == 0:
+                    return idx
+                depth -= 1
+        raise MakefileUnsupportedException("Unterminated reference")
+
+    @staticmethod
+    def _split_args(text, count=None):
+        args = []
+        depth = 0
+        current = ''
+        for char in text:
+            if char in '({':
+                depth += 1
+            elif char in ')}':
+                depth -= 1
+            if char == ',' and depth == 0 and \
+                    (count is None or len(args) < count - 1):
+                args.append(current)
+                current = ''
+                continue
+            current += char
+        args.append(current)
+        return args
+
+    def expand(self, text, depth=0):
+        if depth > 64:
+            raise MakefileUnsupportedException("Recursive variable reference")
+        result = ''
+        idx = 0
+        while True:
+            pos = text.find('$', idx)
+            if pos == -1 or pos == len(text) - 1:
+                return result + text[idx:]
+            result += text[idx:pos]
+            char = text[pos + 1]
+            if char == '$':
+                result += '$'
+                idx = pos + 2
+            elif char in '({':
+                closing = ')' if char == '(' else '}'
+                end = self._find_closing(text, pos + 2, char, closing)
+                result += self._expand_reference(text[pos + 2:end], depth)
+                idx = end + 1
+            else:
+                result += self.get(char)
+                idx = pos + 2
+
+    def _expand_reference(self, ref, depth):
+        match = re.match(r"([a-z-]+)[ \t]+(.*)$", ref, flags=re.DOTALL)
+        if match and match.group(1) in self.FUNCTIONS:
+            func = getattr(self, self.FUNCTIONS[match.group(1)])
+            return func(match.group(2), depth)
+        if match:
+            raise MakefileUnsupportedException(
+                "Unsupported function '%s'" % match.group(1))
+        name = self.expand(ref, depth + 1)
+        # substitution reference $(VAR:a=b)
+        if ':' in name and '=' in name.split(':', 1)[1]:
+            name, subst = name.split(':', 1)
+            pattern, replacement = subst.split('=', 1)
+            if '%' not in pattern:
+                pattern = '%' + pattern
+                replacement = '%' + replacement
+            return ' '.join(self._patsubst_word(pattern, replacement, word)
+                            for word in self._get(name, depth).split())
+        return self._get(name, depth)
+
+    def _get(self, name, depth):
+        recursive, value = self.variables.get(name, (False, ''))
+        if recursive:
+            return self.expand(value, depth + 1)
+        return value
+
+    def _args(self, text, depth, count=None):
+        return [self.expand(arg, depth + 1)
+                for arg in self._split_args(text, count)]
+
+    @staticmethod
+    def _patsubst_word(pattern, replacement, word):
+        if '%' not in pattern:
+            return replacement if word == pattern else word
+        prefix, suffix = pattern.split('%', 1)
+        if word.startswith(prefix) and word.endswith(suffix) and \
+                len(word) >= len(prefix) + len(suffix):
+            stem = word[len(prefix):len(word) - len(suffix)]
+            return replacement.replace('%', stem, 1)
+        return word
+
+    @staticmethod
+    def _match_word(pattern, word):
+        if '%' not in pattern:
+            return word == pattern
+        prefix, suffix = pattern.split('%', 1)
+        return word.startswith(prefix) and word.endswith(suffix) and \
+            len(word) >= len(prefix) + len(suffix)
+
+    def _func_subst(self, text, depth):
+        src, dst, value = self._args(text, depth, 3)
+        return value.replace(src, dst) if src else value
+
+    def _func_patsubst(self, text, depth):
+        pattern, replacement, value = self._args(text, depth, 3)
+        return ' '.join(self._patsubst_word(pattern, replacement, word)
+                        for word in value.split())
+
+    def _func_strip(self, text, depth):
+        return ' '.join(self.expand(text, depth + 1).split())
+
+    def _func_findstring(self, text, depth):
+        needle, value = self._args(text, depth, 2)
+        return needle if needle in value else ''
+
+    def _func_filter(self, text, depth):
+        patterns, value = self._args(text, depth, 2)
+        return ' '.join(word for word in value.split() if any(
+            self._match_word(pattern, word) for pattern in patterns.split()))
+
+    def _func_filter_out(self, text, depth):
+        patterns, value = self._args(text, depth, 2)
+        return ' '.join(word for word in value.split() if not any(
+            self._match_word(pattern, word) for pattern in patterns.split()))
+
+    def _func_sort(self, text, depth):
+        return ' '.join(sorted(set(self.expand(text, depth + 1).split())))
+
+    def _func_word(self, text, depth):
+        index, value = self._args(text, depth, 2)
+        words = value.split()
+        try:
+            index = int(index)
+        except ValueError:
+            raise MakefileUnsupportedException("Invalid word index")
+        return words[index - 1] if 0 < index <= len(words) else ''
+
+    def _func_words(self, text, depth):
+        return str(len(self.expand(text, depth + 1).split()))
+
+    def _func_firstword(self, text, depth):
+        words = self.expand(text, depth + 1).split()
+        return words[0] if words else ''
+
+    def _func_lastword(self, text, depth):
+        words = self.expand(text, depth + 1).split()
+        return words[-1] if words else ''
+
+    def _func_dir(self, text, depth):
+        return ' '.join((os.path.dirname(word) or '.') + '/'
+                        for word in self.expand(text, depth + 1).split())
+
+    def _func_notdir(self, text, depth):
+        return ' '.join(os.path.basename(word)
+                        for word in self.expand(text, depth + 1).split())
+
+    def _func_addprefix(self, text, depth):
+        prefix, value = self._args(text, depth, 2)
+        return ' '.join(prefix + word for word in value.split())
+
+    def _func_addsuffix(self, text, depth):
+        suffix, value = self._args(text, depth, 2)
+        return ' '.join(word + suffix for word in value.split())
+
+    def _func_wildcard(self, text, depth):
+        matches = []
+        for pattern in self.expand(text, depth + 1).split():
+            matches += sorted(
+                os.path.relpath(path, self.curdir)
+                if not os.path.isabs(pattern) else path
+                for path in glob.glob(os.path.join(self.curdir, pattern)))
+        return ' '.join(matches)
+
+    def _func_if(self, text, depth):
+        args = self._split_args(text, 3)
+        if self.expand(args[0], depth + 1).strip():
+            return self.expand(args[1], depth + 1) if len(args) > 1 else ''
+        return self.expand(args[2], depth + 1) if len(args) > 2 else ''
+
+    def _func_or(self, text, depth):
+        for arg in self._split_args(text):
+            value = self.expand(arg, depth + 1).strip()
+            if value:
+                return value
+        return ''
+
+    def _func_and(self, text, depth):
+        value = ''
+        for arg in self._split_args(text):
+            value = self.expand(arg, depth + 1).strip()
+            if not value:
+                return ''
+        return value
+
+    FUNCTIONS = {
+        "subst": "_func_subst",
+        "patsubst": "_func_patsubst",
+        "strip": "_func_strip",
+        "findstring": "_func_findstring",
+        "filter": "_func_filter",
+        "filter-out": "_func_filter_out",
+        "sort": "_func_sort",
+        "word": "_func_word",
+        "words": "_func_words",
+        "firstword": "_func_firstword",
+        "lastword": "_func_lastword",
+        "dir": "_func_dir",
+        "notdir": "_func_notdir",
+        "addprefix": "_func_addprefix",
+        "addsuffix": "_func_addsuffix",
+        "wildcard": "_func_wildcard",
+        "if": "_func_if",
+        "or": "_func_or",
+        "and": "_func_and",
+    }
+
+    @staticmethod
+    def _get_lines(content):
+        lines = []
+        current = ''
+        for line in content.split('\n'):
+            if line.endswith('\\') and not line.endswith('\\\\'):
+                current += line[:-1].rstrip() + ' '
+                continue
+            lines.append(current + (line.lstrip() if current else line))
+            current = ''
+        if current:
+            lines.append(current)
+        return lines
+
+    @staticmethod
+    def _strip_comment(line):
+        idx = 0
+        while True:
+            pos = line.find('#', idx)
+            if pos == -1:
+                return line
+            if pos > 0 and line[pos - 1] == '\\':
+                line = line[:pos - 1] + line[pos:]
+                idx = pos
+                continue
+            return line[:pos]
+
+    def _parse_condition(self, directive, arg):
+        if directive in ("ifdef", "ifndef"):
+            # like make, only the value is checked, it is not expanded
+            name = self.expand(arg).strip()
+            defined = bool(self.variables.get(name, (False, ''))[1])
+            return defined if directive == "ifdef" else not defined
+        arg = arg.strip()
+        if arg.startswith('('):
+            end = self._find_closing(arg, 1, '(', ')')
+            if arg[end + 1:].strip():
+                raise MakefileUnsupportedException("Invalid conditional")
+            values = self._split_args(arg[1:end], 2)
+            if len(values) != 2:
+                raise MakefileUnsupportedException("Invalid conditional")
+            left = self.expand(values[0].strip())
+            right = self.expand(values[1].strip())
+        else:
+            match = re.match(r"""^(["'])(.*?)\1\s+(["'])(.*?)\3$""", arg)
+            if not match:
+                raise MakefileUnsupportedException("Invalid conditional")
+            left = self.expand(match.group(2))
+            right = self.expand(match.group(4))
+        return (left == right) if directive == "ifeq" else (left != right)
+
+    def include(self, makefile, optional=False):
+        try:
+            with open(makefile) as fd:
+                content = fd.read()
+        except FileNotFoundError:
+            if optional:
+                return
+            raise MakefileUnsupportedException(
+                "Cannot find included file '%s'" % makefile)
+        self.parse(content)
+
+    def parse(self, content):
+        # stack of (active, branch taken) per conditional level
+        conditionals = []
+        in_rule = False
+        for line in self._get_lines(content):
+            if line.startswith('\t') and in_rule:
+                # recipe lines do not change variables
+                continue
+            line = self._strip_comment(line).strip()
+            if not line:
+                continue
+            words = line.split(None, 1)
+            directive = words[0]
+            arg = words[1] if len(words) > 1 else ''
+            active = all(level[0] for level in conditionals)
+
+            if directive in CONDITIONAL_DIRECTIVES:
+                taken = active and self._parse_condition(directive, arg)
+                conditionals.append([taken, taken])
+                continue
+            if directive == "else":
+                if not conditionals:
+                    raise MakefileUnsupportedException("Unexpected else")
+                level = conditionals[-1]
+                parent_active = all(level[0] for level in conditionals[:-1])
+                if arg:
+                    sub_words = arg.split(None, 1)
+                    if sub_words[0] not in CONDITIONAL_DIRECTIVES:
+                        raise MakefileUnsupportedException("Invalid else")
+                    taken = parent_active and not level[1] and \
+                        self._parse_condition(
+                            sub_words[0],
+                            sub_words[1] if len(sub_words) > 1 else '')
+                else:
+                    taken = parent_active and not level[1]
+                level[0] = taken
+                level[1] = level[1] or taken
+                continue
+            if directive == "endif":
+                if not conditionals:
+                    raise MakefileUnsupportedException("Unexpected endif")
+                conditionals.pop()
+                continue
+            if not active:
+                continue
+
+            if directive in ("define", "endef", "undefine", "vpath", "load"):
+                raise MakefileUnsupportedException(
+                    "Unsupported directive '%s'" % directive)
+            if directive in ("include", "-include", "sinclude"):
+                for makefile in self.expand(arg).split():
+                    if not os.path.isabs(makefile):
+                        makefile = os.path.join(self.curdir, makefile)
+                    self.include(makefile, optional=directive != "include")
+                in_rule = False
+                continue
+            if directive in ("export", "unexport") and \
+                    not ASSIGNMENT_REGEX.match(line):
+                continue
+
+            match = ASSIGNMENT_REGEX.match(line)
+            if match:
+                self.set(match.group(2), match.group(4).lstrip(),
+                         match.group(3))
+                in_rule = False
+                continue
+            if ANY_ASSIGNMENT_REGEX.match(line):
+                raise MakefileUnsupportedException(
+                    "Unsupported assignment '%s'" % line)
+
+            targets, rest = split_rule(line)
+            if rest is not None:
+                # rule definition: only targets are expanded, prerequisites
+                # are not needed and target-specific variables (e.g.
+                # 'target: VAR = $(shell ...)') are only recorded
+                targets = self.expand(targets)
+                if ANY_ASSIGNMENT_REGEX.match(rest.lstrip()):
+                    self.target_variables.append((targets, rest.strip()))
+                in_rule = True
+                continue
+            expanded = self.expand(line)
+            if ':' in expanded:
+                # rule defined by expanded variables
+                in_rule = True
+                continue
+            if expanded.strip():
+                raise MakefileUnsupportedException(
+                    "Cannot parse line '%s'" % line)
+        if conditionals:
+            raise MakefileUnsupportedException("Missing endif")
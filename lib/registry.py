@@ -0,0 +1,99 @@
+class QubesComponentsRegistryException(Exception):
+    pass
+
+
+# Components of one Qubes release split as needed by builder configuration.
+# Lists keep release.json order.
+class QubesReleaseView:
+    def __init__(self, release, devel=0):
+        self.release = release
+        self.devel = devel
+        self.components = []
+        self.builder_plugins = []
+        self.iso_components = []
+        self.windows_components = []
+        # neither plugin, ISO nor Windows components
+        self.regular_components = []
+        # component -> branch when not the default one of the release
+        self.branches = {}
+        # maintainer -> components names
+        self.maintainers = {}
+
+    def add(self, component):
+        self.components.append(component)
+        regular = True
+        if component.is_plugin_type():
+            self.builder_plugins.append(component)
+            regular = False
+        if component.is_iso_component():
+            self.iso_components.append(component)
+            regular = False
+        if component.is_windows_type():
+            self.windows_components.append(component)
+            regular = False
+        if regular:
+            self.regular_components.append(component)
+
+        branch = component.branch[self.release]
+        if branch != "release%s" % self.release and \
+                not (branch == "master" and self.devel == 1):
+            self.branches[component] = branch
+
+        for maintainer in component.get_maintainers():
+            self.maintainers.setdefault(maintainer, []).append(component.name)
+
+
+# Components by name and per release views, built once and shared by all
+# commands.
+class QubesComponentsRegistry:
+    def __init__(self):
+        self.components = []
+        self.by_name = {}
+        self.views = {}
+
+    def add(self, component):
+        if component.name in self.by_name:
+            raise QubesComponentsRegistryException(
+                "Component %s already registered" % component.name)
+        self.components.append(component)
+        self.by_name[component.name] = component
+        # views are built again on next access
+        self.views = {}
+
+    def replace(self, component):
+        # keep the position of the replaced component
+        old_component = self.by_name.get(component.name)
+        if old_component is None:
+            raise QubesComponentsRegistryException(
+                "Component %s is not registered" % component.name)
+        idx = self.components.index(old_component)
+        self.components[idx] = component
+        self.by_name[component.name] = component
+        self.views = {}
+
+    def remove(self, name):
+        component = self.by_name.pop(name, None)
+        if component:
+            self.components.remove(component)
+            self.views = {}
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def get_names(self):
+        return [component.name for component in self.components]
+
+    def get_from_names(self, names):
+        if 'all' in names:
+            return self.components
+        return [self.by_name[name] for name in names if name in self.by_name]
+
+    def get_release_view(self, release, devel=0):
+        view = self.views.get(release)
+        if view is None or view.devel != devel:
+            view = QubesReleaseView(release, devel)
+            for component in self.components:
+                if release in component.releases:
+                    view.add(component)
+            self.views[release] = view
+        return view
@@ -1,29 +1,97 @@
 import os
+import hashlib
 import subprocess
 import tempfile
+import threading
 import json
 
-from lib.common import get_version, get_release
+from lib import trace
+from lib.common import QubesSourceSnapshot, SPEC_EXTERNAL_INPUTS_REGEX
+from lib.spec_parser import SpecParser, SpecParserUnsupportedException, \
+    get_unique
+
+try:
+    import rpm
+except ImportError:
+    rpm = None
+
+RPMSPEC = "/usr/bin/rpmspec"
+# built packages with their provides, so that a single query gives both
+# packages and provides of a spec
+RPMSPEC_QUERY_FORMAT = \
+    '\\{"name": "%{name}", "version": "%{version}", ' \
+    '"release": "%{release}", "arch": "%{arch}", ' \
+    '"provides": "[%{PROVIDENAME} ]"\\}\n'
+# build requirements of the source package
+RPMSPEC_REQUIRES_QUERY_FORMAT = '[%{REQUIRENAME}\n]'
+
+# rpm library macros are process wide: spec parsing through the bindings is
+# serialized and macros are reloaded only when the dist context changes
+RPM_LOCK = threading.Lock()
+RPM_CONTEXT = {"macros": None}
+
 
 class RPMParserException(Exception):
     pass
 
 
+def get_header_strings(header, tag):
+    values = header[tag]
+    if not isinstance(values, list):
+        values = [values]
+    return [value.decode('utf-8') if isinstance(value, bytes) else value
+            for value in values]
+
+
+def get_dependencies(build_requires, provides, names):
+    # same result as SpecParser.get_dependencies(): rpm internal
+    # requirements, rich dependencies and packages own names (including
+    # arch specific ones like 'name(x86-64)') are left out
+    build_requires = [name for name in build_requires
+                      if not name.startswith('rpmlib(') and
+                      not name.startswith('(')]
+    provides = [name for name in provides if name not in names and not (
+        name.endswith(')') and name.split('(')[0] in names)]
+    return {
+        "build_requires": get_unique(build_requires),
+        "provides": get_unique(provides)
+    }
+
+
+def get_default_backend():
+    return "rpm" if rpm else "rpmspec"
+
+
 class RPMParser:
 
-    def __init__(self, orig_src, spec):
+    def __init__(self, orig_src, spec, dist=None, backend="auto",
+                 snapshot=None, memo=None):
         self.orig_src = orig_src
         self.spec = os.path.join(orig_src, spec)
+        self.dist = dist
+        self.backend = backend
+        self.snapshot = snapshot or QubesSourceSnapshot(orig_src)
+        # run memo shared by specs rendered identically for several
+        # dists, package sets or releases
+        self.memo = memo
         self.packages = []
 
     def get_packages(self):
         self.parse()
         return self.packages
 
-    def parse(self):
-        filespec = self.spec
+    def get_macros(self):
+        if self.dist:
+            return self.dist.get_rpm_macros()
+        return {}
+
+    def get_filespec(self):
         if os.path.exists(self.spec + '.in'):
-            filespec = self.spec + '.in'
+            return self.spec + '.in'
+        return self.spec
+
+    def parse(self):
+        filespec = self.get_filespec()
         raw_pkg_infos = self.get_raw_infos(filespec)
         if raw_pkg_infos:
             for raw_info in raw_pkg_infos:
@@ -32,28 +100,180 @@ class RPMParser:
                     self.packages.append(pkg_info)
 
     def get_raw_infos(self, filespec):
+        with trace.span("spec", "parse",
+                        spec=os.path.relpath(filespec, self.orig_src)):
+            return self._get_raw_infos(filespec)
+
+    def _get_raw_infos(self, filespec):
+        return self._query_spec(filespec, "packages")
+
+    def get_dependencies(self):
+        # names needed for building the spec and names provided by its
+        # packages, None if there is no spec
+        filespec = self.get_filespec()
+        with trace.span("spec dependencies", "parse",
+                        spec=os.path.relpath(filespec, self.orig_src)):
+            return self._query_spec(filespec, "dependencies")
+
+    def _query_spec(self, filespec, query):
         if os.path.exists(filespec):
             with open(filespec, "r") as fd:
                 content = self.get_rendered_spec(fd.read().strip())
-            curr_dir = os.path.dirname(filespec)
-            with tempfile.NamedTemporaryFile(dir=curr_dir) as fd_spec:
-                fd_spec.write(content.encode('utf-8'))
-                fd_spec.seek(0)
-                spec = fd_spec.name
-                cmd = ["/usr/bin/rpmspec", "--builtrpms", "-q", "--qf",
-                       '\{"name": "%{name}", "version": "%{version}", "release": "%{release}", "arch": "%{arch}"\}\n', spec]
-                kwargs = {
-                    "cwd": curr_dir,
-                    "text": True
-                }
-                if os.environ.get('DEBUG') != 1:
-                    kwargs["stderr"] = subprocess.DEVNULL
-                output = subprocess.check_output(cmd, **kwargs).rstrip('\n')
-                return output.split('\n')
+            key = self._get_memo_key(query, filespec, content)
+            if key is None:
+                return self.query(filespec, content, query)
+            return self.memo.get_or_compute(
+                key, lambda: self.query(filespec, content, query))
+
+    def _get_memo_key(self, query, filespec, content):
+        # results of specs reading other files are not shared
+        encoded = content.encode('utf-8')
+        if self.memo is None or SPEC_EXTERNAL_INPUTS_REGEX.search(encoded):
+            return None
+        # version and rel are part of the key for specs reading
+        # them from the sources folder
+        return ("spec", query, os.path.basename(self.orig_src),
+                os.path.relpath(filespec, self.orig_src),
+                hashlib.sha256(encoded).hexdigest(),
+                self.snapshot.version, self.snapshot.release,
+                self.backend, tuple(sorted(self.get_macros().items())))
+
+    def query(self, filespec, content, query="packages"):
+        # content is the rendered filespec
+        if query == "dependencies":
+            query_native = self.query_native_dependencies
+            query_rpm = self.query_rpm_dependencies
+            query_rpmspec = self.query_rpmspec_dependencies
+        else:
+            query_native = self.query_native
+            query_rpm = self.query_rpm
+            query_rpmspec = self.query_rpmspec
+        backend = self.backend
+        if backend == "auto":
+            # rpm is only needed for what the native parser does
+            # not understand
+            try:
+                return query_native(content)
+            except SpecParserUnsupportedException:
+                backend = get_default_backend()
+        curr_dir = os.path.dirname(filespec)
+        with tempfile.NamedTemporaryFile(dir=curr_dir) as fd_spec:
+            fd_spec.write(content.encode('utf-8'))
+            fd_spec.seek(0)
+            if backend == "rpm":
+                try:
+                    return query_rpm(fd_spec.name)
+                except RPMParserException:
+                    pass
+            return query_rpmspec(fd_spec.name, filespec, content)
+
+    def query_native(self, content):
+        return SpecParser(content, self.get_macros()).get_packages()
+
+    def query_native_dependencies(self, content):
+        return SpecParser(content, self.get_macros()).get_dependencies()
+
+    def _get_rpm_spec(self, spec):
+        # to be called with RPM_LOCK held
+        if not rpm:
+            raise RPMParserException('rpm Python bindings are not available')
+        macros = self.get_macros()
+        if RPM_CONTEXT["macros"] != macros:
+            rpm.reloadConfig()
+            for name, value in macros.items():
+                if value is None:
+                    rpm.delMacro(name)
+                else:
+                    rpm.addMacro(name, value)
+            RPM_CONTEXT["macros"] = macros
+        try:
+            return rpm.spec(spec)
+        except ValueError as e:
+            raise RPMParserException(
+                'Cannot parse %s: %s' % (self.spec, str(e)))
+
+    def query_rpm(self, spec):
+        with RPM_LOCK, trace.span("rpm", "parse"):
+            parsed_spec = self._get_rpm_spec(spec)
+            raw_infos = []
+            for pkg in parsed_spec.packages:
+                # only packages with a %files section are built
+                # like with 'rpmspec --builtrpms'
+                if pkg.fileList is None:
+                    continue
+                raw_info = {}
+                for key, tag in (("name", rpm.RPMTAG_NAME),
+                                 ("version", rpm.RPMTAG_VERSION),
+                                 ("release", rpm.RPMTAG_RELEASE),
+                                 ("arch", rpm.RPMTAG_ARCH)):
+                    value = pkg.header[tag]
+                    if isinstance(value, bytes):
+                        value = value.decode('utf-8')
+                    raw_info[key] = value
+                raw_infos.append(raw_info)
+        return raw_infos
+
+    def query_rpm_dependencies(self, spec):
+        with RPM_LOCK, trace.span("rpm", "parse"):
+            parsed_spec = self._get_rpm_spec(spec)
+            build_requires = get_header_strings(
+                parsed_spec.sourceHeader, rpm.RPMTAG_REQUIRENAME)
+            names = []
+            provides = []
+            for pkg in parsed_spec.packages:
+                if pkg.fileList is None:
+                    continue
+                names += get_header_strings(pkg.header, rpm.RPMTAG_NAME)
+                provides += get_header_strings(
+                    pkg.header, rpm.RPMTAG_PROVIDENAME)
+        return get_dependencies(build_requires, provides, names)
+
+    def _rpmspec(self, spec, mode, query_format):
+        cmd = [RPMSPEC, mode, "-q"]
+        for name, value in self.get_macros().items():
+            if value is None:
+                cmd += ["--undefine", name]
+            else:
+                cmd += ["--define", "%s %s" % (name, value)]
+        cmd += ["--qf", query_format, spec]
+        kwargs = {
+            "cwd": os.path.dirname(spec),
+            "text": True
+        }
+        if os.environ.get('DEBUG') != 1:
+            kwargs["stderr"] = subprocess.DEVNULL
+        with trace.span("rpmspec", "subprocess"):
+            output = subprocess.check_output(cmd, **kwargs).rstrip('\n')
+        return [line for line in output.split('\n') if line]
+
+    def _query_rpmspec_builtrpms(self, spec, filespec, content):
+        # shared by packages and dependencies queries of the spec
+        def query():
+            return [json.loads(line) for line in self._rpmspec(
+                spec, "--builtrpms", RPMSPEC_QUERY_FORMAT)]
+        key = self._get_memo_key("rpmspec-builtrpms", filespec, content)
+        if key is None:
+            return query()
+        return self.memo.get_or_compute(key, query)
+
+    def query_rpmspec(self, spec, filespec, content):
+        return self._query_rpmspec_builtrpms(spec, filespec, content)
+
+    def query_rpmspec_dependencies(self, spec, filespec, content):
+        # binary packages headers have no build requirements, only them
+        # need a query of the source package
+        build_requires = self._rpmspec(
+            spec, "--srpm", RPMSPEC_REQUIRES_QUERY_FORMAT)
+        names = []
+        provides = []
+        for raw_info in self._query_rpmspec_builtrpms(
+                spec, filespec, content):
+            names.append(raw_info["name"])
+            provides += raw_info["provides"].split()
+        return get_dependencies(build_requires, provides, names)
 
     @staticmethod
     def get_info(raw_info, filtered_arches=None):
-        raw_info = json.loads(raw_info)
         pkg = None
         name = raw_info["name"]
         version = raw_info["version"]
@@ -77,8 +297,8 @@ class RPMParser:
         return pkg
 
     def get_rendered_spec(self, content):
-        version = get_version(self.orig_src)
-        release = get_release(self.orig_src)
+        version = self.snapshot.version
+        release = self.snapshot.release
         if not version:
             version = ''
         if not release:
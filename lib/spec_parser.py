@@ -0,0 +1,510 @@
+import re
+
+
+class SpecParserUnsupportedException(Exception):
+    pass
+
+
+# architecture rpmspec runs on
+HOST_ARCH = "x86_64"
+
+SECTIONS = {
+    "package", "description", "prep", "build", "install", "check", "clean",
+    "files", "changelog", "pre", "post", "preun", "postun", "pretrans",
+    "posttrans", "verifyscript", "triggerprein", "triggerin", "triggerun",
+    "triggerpostun", "filetriggerin", "filetriggerun", "filetriggerpostun",
+    "transfiletriggerin", "transfiletriggerun", "transfiletriggerpostun",
+    "generate_buildrequires", "conf", "sourcelist", "patchlist",
+}
+
+TAG_REGEX = re.compile(r"^([A-Za-z][A-Za-z0-9]*)(\([^)]*\))?\s*:\s*(.*)$")
+EXPRESSION_TOKEN_REGEX = re.compile(
+    r'\s*(?:(\d+)|"([^"]*)"|(==|!=|<=|>=|&&|\|\||[<>!()+\-*/]))')
+DEPENDENCY_OPERATORS = {"<", ">", "=", "<=", ">=", "=="}
+
+
+def get_dependencies_names(value):
+    # 'a >= 1.0, b c' -> ['a', 'b', 'c']
+    names = []
+    words = value.replace(',', ' ').split()
+    idx = 0
+    while idx < len(words):
+        if words[idx] in DEPENDENCY_OPERATORS:
+            # skip the version
+            idx += 2
+            continue
+        if words[idx].startswith('('):
+            raise SpecParserUnsupportedException(
+                "Unsupported rich dependency '%s'" % value)
+        names.append(words[idx])
+        idx += 1
+    return names
+
+
+def get_unique(names):
+    # first occurrences only, in order
+    return list(dict.fromkeys(names))
+
+
+# Parser of the preamble of spec files: names, version, release and
+# architecture of built packages, with the common macros and conditionals.
+# Whatever could make the result differ from rpmspec (shell or lua macros,
+# %include, generated debuginfo packages...) raises
+# SpecParserUnsupportedException so that rpm can be used instead.
+class SpecParser:
+    def __init__(self, content, macros=None):
+        self.content = content
+        # name -> value, None value is a parametric macro
+        self.macros = {
+            "nil": "",
+            "_arch": HOST_ARCH,
+            "_target_cpu": HOST_ARCH,
+        }
+        for name, value in (macros or {}).items():
+            if value is not None:
+                self.macros[name] = value
+        self.packages = []
+        self.build_requires = []
+        self.dependencies_error = None
+
+    def expand(self, text, depth=0):
+        if depth > 64:
+            raise SpecParserUnsupportedException("Recursive macro expansion")
+        result = ''
+        idx = 0
+        while True:
+            pos = text.find('%', idx)
+            if pos == -1 or pos == len(text) - 1:
+                return result + text[idx:]
+            result += text[idx:pos]
+            char = text[pos + 1]
+            if char == '%':
+                result += '%'
+                idx = pos + 2
+            elif char == '{':
+                end = self._find_closing(text, pos + 2)
+                result += self._expand_braces(text[pos + 2:end], depth)
+                idx = end + 1
+            elif char in '([':
+                raise SpecParserUnsupportedException(
+                    "Unsupported macro expression '%%%s'" % char)
+            else:
+                match = re.match(r"[A-Za-z_][A-Za-z0-9_]*", text[pos + 1:])
+                if not match:
+                    result += '%'
+                    idx = pos + 1
+                    continue
+                name = match.group(0)
+                result += self._get_macro(name, '%' + name, depth)
+                idx = pos + 1 + len(name)
+
+    @staticmethod
+    def _find_closing(text, start):
+        depth = 0
+        for idx in range(start, len(text)):
+            if text[idx] == '{':
+                depth += 1
+            elif text[idx] == '}':
+                if depth == 0:
+                    return idx
+                depth -= 1
+        raise SpecParserUnsupportedException("Unterminated macro")
+
+    def _get_macro(self, name, literal, depth):
+        if name not in self.macros:
+            # rpm keeps undefined macros as is
+            return literal
+        value = self.macros[name]
+        if value is None:
+            raise SpecParserUnsupportedException(
+                "Unsupported parametric macro '%s'" % name)
+        return self.expand(value, depth + 1)
+
+    def _expand_braces(self, body, depth):
+        match = re.match(r"^([!?]*)([A-Za-z_][A-Za-z0-9_]*)(?::(.*))?$", body,
+                         flags=re.DOTALL)
+        if not match:
+            words = body.split(None, 1)
+            if len(words) == 2 and words[0] in ("with", "without"):
+                defined = ("with_%s" % words[1].strip()) in self.macros
+                if words[0] == "without":
+                    defined = not defined
+                return "1" if defined else "0"
+            raise SpecParserUnsupportedException(
+                "Unsupported macro '%%{%s}'" % body)
+        flags, name, alternative = match.groups()
+        if name == "expand" and not flags and alternative is not None:
+            return self.expand(self.expand(alternative, depth + 1), depth + 1)
+        if name in ("lua", "shrink", "quote", "url2path", "uncompress",
+                    "getenv", "load", "echo", "warn", "error") or \
+                (alternative is not None and '?' not in flags):
+            raise SpecParserUnsupportedException(
+                "Unsupported macro '%%{%s}'" % body)
+        if '?' not in flags:
+            return self._get_macro(name, '%{' + body + '}', depth)
+        defined = name in self.macros
+        if '!' in flags:
+            defined = not defined
+            if alternative is None:
+                return ''
+        if not defined:
+            return ''
+        if alternative is not None:
+            return self.expand(alternative, depth + 1)
+        return self._get_macro(name, '', depth)
+
+    def _evaluate(self, expression):
+        tokens = []
+        pos = 0
+        expression = expression.strip()
+        while pos < len(expression):
+            match = EXPRESSION_TOKEN_REGEX.match(expression, pos)
+            if not match or match.end() == pos:
+                raise SpecParserUnsupportedException(
+                    "Unsupported expression '%s'" % expression)
+            number, string, operator = match.groups()
+            if number is not None:
+                tokens.append(("value", int(number)))
+            elif string is not None:
+                tokens.append(("value", string))
+            else:
+                tokens.append(("op", operator))
+            pos = match.end()
+            while pos < len(expression) and expression[pos].isspace():
+                pos += 1
+        if not tokens:
+            raise SpecParserUnsupportedException("Empty expression")
+        value, pos = self._parse_or(tokens, 0)
+        if pos != len(tokens):
+            raise SpecParserUnsupportedException(
+                "Unsupported expression '%s'" % expression)
+        return bool(value)
+
+    def _parse_binary(self, tokens, pos, operators, parse_operand):
+        left, pos = parse_operand(tokens, pos)
+        while pos < len(tokens) and tokens[pos] in \
+                [("op", operator) for operator in operators]:
+            operator = tokens[pos][1]
+            right, pos = parse_operand(tokens, pos + 1)
+            if type(left) != type(right):
+                raise SpecParserUnsupportedException(
+                    "Types mismatch in expression")
+            if operator == '||':
+                left = left or right
+            elif operator == '&&':
+                left = left and right
+            elif operator == '==':
+                left = int(left == right)
+            elif operator == '!=':
+                left = int(left != right)
+            elif operator == '<':
+                left = int(left < right)
+            elif operator == '>':
+                left = int(left > right)
+            elif operator == '<=':
+                left = int(left <= right)
+            elif operator == '>=':
+                left = int(left >= right)
+            elif operator == '+':
+                left = left + right
+            elif operator == '-':
+                left = left - right
+            elif operator == '*':
+                left = left * right
+            elif operator == '/':
+                if not right:
+                    raise SpecParserUnsupportedException("Division by zero")
+                left = left // right
+        return left, pos
+
+    def _parse_or(self, tokens, pos):
+        return self._parse_binary(tokens, pos, ('||',), self._parse_and)
+
+    def _parse_and(self, tokens, pos):
+        return self._parse_binary(tokens, pos, ('&&',), self._parse_compare)
+
+    def _parse_compare(self, tokens, pos):
+        return self._parse_binary(tokens, pos,
+                                  ('==', '!=', '<=', '>=', '<', '>'),
+                                  self._parse_sum)
+
+    def _parse_sum(self, tokens, pos):
+        return self._parse_binary(tokens, pos, ('+', '-'), self._parse_product)
+
+    def _parse_product(self, tokens, pos):
+        return self._parse_binary(tokens, pos, ('*', '/'), self._parse_unary)
+
+    def _parse_unary(self, tokens, pos):
+        if pos >= len(tokens):
+            raise SpecParserUnsupportedException("Truncated expression")
+        kind, value = tokens[pos]
+        if kind == "value":
+            return value, pos + 1
+        if value == '!':
+            operand, pos = self._parse_unary(tokens, pos + 1)
+            return int(not operand), pos
+        if value == '-':
+            operand, pos = self._parse_unary(tokens, pos + 1)
+            return -operand, pos
+        if value == '(':
+            operand, pos = self._parse_or(tokens, pos + 1)
+            if pos >= len(tokens) or tokens[pos] != ("op", ')'):
+                raise SpecParserUnsupportedException("Missing parenthesis")
+            return operand, pos + 1
+        raise SpecParserUnsupportedException("Unexpected operator '%s'" % value)
+
+    def _evaluate_arch(self, directive, arg):
+        expanded = self.expand(arg)
+        if '%' in expanded:
+            # undefined macros probably defined on rpm side
+            raise SpecParserUnsupportedException(
+                "Unknown macros in '%s'" % arg)
+        arches = expanded.split()
+        if directive in ("ifarch", "elifarch"):
+            return HOST_ARCH in arches
+        if directive in ("ifnarch", "elifnarch"):
+            return HOST_ARCH not in arches
+        if directive in ("ifos", "elifos"):
+            return "linux" in arches
+        return "linux" not in arches
+
+    def _evaluate_condition(self, directive, arg):
+        if directive in ("if", "elif"):
+            expression = self.expand(arg)
+            if '%' in expression:
+                # undefined macros probably defined on rpm side
+                raise SpecParserUnsupportedException(
+                    "Unknown macros in '%s'" % arg)
+            return self._evaluate(expression)
+        return self._evaluate_arch(directive, arg)
+
+    @staticmethod
+    def _get_lines(content):
+        lines = []
+        current = ''
+        for line in content.split('\n'):
+            # macros definitions can be continued with a backslash
+            if current or re.match(r"^\s*%(global|define)\s", line):
+                if line.endswith('\\'):
+                    current += line[:-1] + '\n'
+                    continue
+                line = current + line
+                current = ''
+            lines.append(line)
+        if current:
+            lines.append(current)
+        return lines
+
+    def _define(self, line):
+        words = line.split(None, 2)
+        if len(words) < 3:
+            raise SpecParserUnsupportedException(
+                "Invalid macro definition '%s'" % line)
+        directive, name, value = words
+        if name.endswith(')'):
+            # parametric macros are only supported if never used
+            self.macros[name.split('(')[0]] = None
+            return
+        value = value.strip()
+        if directive == "%global":
+            value = self.expand(value)
+        self.macros[name] = value
+
+    def _get_package_name(self, args):
+        # %package, %files... arguments: '-n name' or 'suffix'
+        words = self.expand(args).split()
+        idx = 0
+        while idx < len(words):
+            if words[idx] == '-n' and idx + 1 < len(words):
+                return words[idx + 1]
+            if words[idx] in ('-f', '-p') and idx + 1 < len(words):
+                idx += 2
+                continue
+            if words[idx].startswith('-'):
+                idx += 1
+                continue
+            return '%s-%s' % (self.macros.get("name", ''), words[idx])
+        return self.macros.get("name")
+
+    def _set_tag(self, package, tag, value):
+        # only tags having an influence on built packages are expanded
+        tag = tag.lower()
+        if tag in ("name", "version", "release"):
+            if package is not self.packages[0]:
+                raise SpecParserUnsupportedException(
+                    "Unexpected tag '%s' in subpackage" % tag)
+            value = self.expand(value).strip()
+            self.macros[tag] = value
+            package[tag] = value
+        elif tag in ("buildarch", "buildarchitectures"):
+            value = self.expand(value)
+            if '%' in value:
+                raise SpecParserUnsupportedException(
+                    "Cannot determine BuildArch")
+            package["buildarch"] = value.split()
+        elif tag == "exclusivearch":
+            package["exclusivearch"] = self.expand(value).split()
+        elif tag == "excludearch":
+            package["excludearch"] = self.expand(value).split()
+        elif tag in ("buildrequires", "provides"):
+            # not needed for packages: failures are only raised by
+            # get_dependencies()
+            try:
+                value = self.expand(value)
+                if '%' in value:
+                    raise SpecParserUnsupportedException(
+                        "Cannot determine %s" % tag)
+                names = get_dependencies_names(value)
+            except SpecParserUnsupportedException as e:
+                self.dependencies_error = e
+                return
+            if tag == "buildrequires":
+                self.build_requires += names
+            else:
+                package.setdefault("provides", []).extend(names)
+
+    def parse(self):
+        main = {"name": None, "files": False}
+        self.packages = [main]
+        self.build_requires = []
+        self.dependencies_error = None
+        # stack of [active, branch taken] per conditional level
+        conditionals = []
+        package = main
+        section = "preamble"
+        for line in self._get_lines(self.content):
+            stripped = line.strip()
+            match = re.match(r"^%([A-Za-z_]+)\b\s*(.*)$", stripped,
+                             flags=re.DOTALL)
+            directive = match.group(1) if match else None
+            arg = match.group(2) if match else ''
+            active = all(level[0] for level in conditionals)
+
+            if directive in ("if", "ifarch", "ifnarch", "ifos", "ifnos"):
+                taken = active and self._evaluate_condition(directive, arg)
+                conditionals.append([taken, taken])
+                continue
+            if directive in ("elif", "elifarch", "elifnarch", "elifos",
+                             "elifnos", "else"):
+                if not conditionals:
+                    raise SpecParserUnsupportedException(
+                        "Unexpected %%%s" % directive)
+                level = conditionals[-1]
+                parent_active = all(
+                    level[0] for level in conditionals[:-1])
+                taken = parent_active and not level[1]
+                if taken and directive != "else":
+                    taken = self._evaluate_condition(directive, arg)
+                level[0] = taken
+                level[1] = level[1] or taken
+                continue
+            if directive == "endif":
+                if not conditionals:
+                    raise SpecParserUnsupportedException("Unexpected %endif")
+                conditionals.pop()
+                continue
+            if not active:
+                continue
+
+            if directive in ("global", "define"):
+                self._define(stripped)
+                continue
+            if directive == "undefine":
+                self.macros.pop(arg.strip(), None)
+                continue
+            if directive in ("bcond_with", "bcond_without"):
+                # like rpm, only enabled options define a macro
+                if directive == "bcond_without":
+                    self.macros["with_%s" % arg.strip()] = "1"
+                continue
+            if directive in ("include", "load"):
+                raise SpecParserUnsupportedException(
+                    "Unsupported directive '%%%s'" % directive)
+            if directive in SECTIONS:
+                section = directive
+                if directive == "package":
+                    package = {"name": self._get_package_name(arg),
+                               "files": False}
+                    self.packages.append(package)
+                    section = "preamble"
+                elif directive == "files":
+                    name = self._get_package_name(arg)
+                    for pkg in self.packages:
+                        if pkg["name"] == name:
+                            pkg["files"] = True
+                            break
+                    else:
+                        raise SpecParserUnsupportedException(
+                            "Unknown package '%s' in %%files" % name)
+                continue
+            if section != "preamble" or not stripped or \
+                    stripped.startswith('#'):
+                continue
+
+            tag_match = TAG_REGEX.match(stripped)
+            if not tag_match:
+                # macros expanding to tags or to nothing
+                expanded = self.expand(stripped).strip()
+                if not expanded:
+                    continue
+                tag_match = TAG_REGEX.match(expanded)
+                if not tag_match:
+                    raise SpecParserUnsupportedException(
+                        "Cannot parse line '%s'" % stripped)
+            self._set_tag(package, tag_match.group(1), tag_match.group(3))
+        if conditionals:
+            raise SpecParserUnsupportedException("Missing %endif")
+
+    def get_packages(self):
+        self.parse()
+        main = self.packages[0]
+        for tag in ("name", "version", "release"):
+            if not main.get(tag) or '%' in main[tag]:
+                raise SpecParserUnsupportedException(
+                    "Cannot determine %s" % tag)
+        if '%' in ''.join(pkg["name"] for pkg in self.packages):
+            raise SpecParserUnsupportedException("Cannot determine names")
+        main_arches = main.get("buildarch", [])
+        exclusive = main.get("exclusivearch")
+        if exclusive and HOST_ARCH not in exclusive and \
+                main_arches != ["noarch"]:
+            raise SpecParserUnsupportedException("Excluded architecture")
+        if HOST_ARCH in main.get("excludearch", []):
+            raise SpecParserUnsupportedException("Excluded architecture")
+
+        packages = []
+        for pkg in self.packages:
+            if not pkg["files"]:
+                continue
+            arches = pkg.get("buildarch", main_arches)
+            if len(arches) > 1 or (arches and arches[0] != "noarch"):
+                raise SpecParserUnsupportedException(
+                    "Unsupported BuildArch '%s'" % ' '.join(arches))
+            packages.append({
+                "name": pkg["name"],
+                "version": main["version"],
+                "release": main["release"],
+                "arch": "noarch" if arches else HOST_ARCH
+            })
+        if any(pkg["arch"] != "noarch" for pkg in packages) and \
+                self.macros.get("debug_package") not in ("%{nil}", ""):
+            # debuginfo packages generation depends on host configuration
+            raise SpecParserUnsupportedException(
+                "Arch dependent packages with debuginfo")
+        return packages
+
+    def get_dependencies(self):
+        # names needed for building the spec and names provided by its
+        # packages besides their own names
+        names = [pkg["name"] for pkg in self.get_packages()]
+        if self.dependencies_error:
+            raise self.dependencies_error
+        provides = []
+        for pkg in self.packages:
+            if pkg["name"] in names:
+                provides += pkg.get("provides", [])
+        return {
+            "build_requires": get_unique(self.build_requires),
+            "provides": get_unique(
+                [name for name in provides if name not in names])
+        }
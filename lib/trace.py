@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+# no-op span returned while tracing is disabled
+NULL_SPAN = contextlib.nullcontext()
+
+TRACER = None
+
+
+# Spans of the phases of a run (checkout, make, spec and control parsing,
+# writes...). Arguments of a span (component, release, dist...) are
+# inherited by the spans nested in it within the same thread.
+class QubesTracer:
+    def __init__(self):
+        self.origin = time.perf_counter_ns()
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def span(self, name, category, args):
+        parent = getattr(self.local, 'args', {})
+        self.local.args = dict(parent, **args)
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            with self.lock:
+                self.events.append((name, category, start, end,
+                                    threading.get_ident(), self.local.args))
+            self.local.args = parent
+
+    def to_chrome_trace(self):
+        # complete events of the Trace Event Format, timestamps in us
+        pid = os.getpid()
+        events = []
+        for name, category, start, end, tid, args in self.events:
+            events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.origin) / 1000,
+                "dur": (end - start) / 1000,
+                "pid": pid,
+                "tid": tid,
+                "args": args
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path):
+        with open(path, 'w') as fd:
+            fd.write(json.dumps(self.to_chrome_trace()))
+
+    def get_summary(self, cache=None, top=10):
+        phases = {}
+        components = {}
+        for name, category, start, end, _, args in self.events:
+            duration = (end - start) / 1e9
+            count, total = phases.get((category, name), (0, 0))
+            phases[(category, name)] = (count + 1, total + duration)
+            if (category, name) == ("update", "update"):
+                components[args["component"]] = \
+                    components.get(args["component"], 0) + duration
+
+        lines = ["%-12s %-24s %8s %10s" % ("category", "phase", "count",
+                                           "total (s)")]
+        for (category, name), (count, total) in sorted(
+                phases.items(), key=lambda item: -item[1][1]):
+            lines.append("%-12s %-24s %8d %10.3f" % (
+                category, name, count, total))
+
+        lines += ["", "%-36s %10s" % ("component", "wall (s)")]
+        for component, total in sorted(
+                components.items(), key=lambda item: -item[1])[:top]:
+            lines.append("%-36s %10.3f" % (component, total))
+
+        subprocesses = sum(count for (category, _), (count, _) in
+                           phases.items() if category == "subprocess")
+        lines += ["", "Subprocesses: %d" % subprocesses]
+        if cache:
+            lookups = cache.hits + cache.misses
+            lines.append(
+                "Parse cache: %d hits, %d misses (%.1f%% hit rate)" % (
+                    cache.hits, cache.misses,
+                    100 * cache.hits / lookups if lookups else 0))
+        return '\n'.join(lines)
+
+
+def enable():
+    global TRACER
+    TRACER = QubesTracer()
+    return TRACER
+
+
+def span(name, category="update", **args):
+    if TRACER is None:
+        return NULL_SPAN
+    return TRACER.span(name, category, args)
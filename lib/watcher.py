@@ -0,0 +1,202 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from lib.index import get_stamp
+
+# inotify(7) events
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_ONLYDIR = 0x01000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+    IN_DELETE | IN_ATTRIB | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# spec files and debian folders are at most in a subfolder of a subfolder
+# of components sources
+MAX_DEPTH = 2
+
+
+class QubesWatcherException(Exception):
+    pass
+
+
+def is_watched_file(filename):
+    # files the packages lists of a component are computed from
+    return filename in ('Makefile.builder', 'version', 'rel', 'control',
+                        'changelog') or \
+        filename.endswith('.spec') or filename.endswith('.spec.in')
+
+
+def get_watched_dirs(path, max_depth=MAX_DEPTH):
+    # (folder, depth) of a component sources without git metadata
+    for root, dirs, _ in os.walk(path):
+        depth = 0 if root == path else \
+            os.path.relpath(root, path).count(os.sep) + 1
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        if depth >= max_depth:
+            dirs[:] = []
+        yield root, depth
+
+
+class QubesInotify:
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            self.add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError):
+            raise QubesWatcherException("inotify is not available")
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise QubesWatcherException(
+                "Cannot initialize inotify: %s" %
+                os.strerror(ctypes.get_errno()))
+        # watch descriptor -> (component, sources path, folder, depth)
+        self.watches = {}
+
+    def watch(self, name, root, path, depth):
+        wd = self.add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # removed meanwhile
+                return
+            raise QubesWatcherException(
+                "Cannot watch %s: %s" % (path, os.strerror(err)))
+        self.watches[wd] = (name, root, path, depth)
+
+    def read_events(self, timeout):
+        # (component, path relative to its sources) of changed files
+        changes = []
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changes
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changes
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            filename = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+            name, root, path, depth = self.watches[wd]
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and depth < MAX_DEPTH \
+                        and not filename.startswith('.'):
+                    # new folder may already hold watched files
+                    new_path = os.path.join(path, filename)
+                    for folder, new_depth in get_watched_dirs(
+                            new_path, MAX_DEPTH - depth - 1):
+                        self.watch(name, root, folder, depth + 1 + new_depth)
+                        try:
+                            entries = os.listdir(folder)
+                        except OSError:
+                            continue
+                        for entry in entries:
+                            if is_watched_file(entry):
+                                changes.append((name, os.path.relpath(
+                                    os.path.join(folder, entry), root)))
+                continue
+            if is_watched_file(filename):
+                changes.append((name, os.path.relpath(
+                    os.path.join(path, filename), root)))
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Changes of the files packages lists are computed from in components
+# sources. Bursts of events (editors saving, git checkout...) are merged
+# until nothing changed for debounce seconds. Without inotify, files stamps
+# are polled every poll_interval seconds.
+class QubesSourcesWatcher:
+    def __init__(self, paths, debounce=0.3, poll_interval=1.0):
+        # component -> sources path
+        self.paths = paths
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.inotify = None
+        self.stamps = {}
+        try:
+            self.inotify = QubesInotify()
+            for name, path in paths.items():
+                for folder, depth in get_watched_dirs(path):
+                    self.inotify.watch(name, path, folder, depth)
+        except QubesWatcherException:
+            if self.inotify:
+                self.inotify.close()
+                self.inotify = None
+            self.stamps = self.get_stamps()
+
+    def is_polling(self):
+        return self.inotify is None
+
+    def get_stamps(self):
+        stamps = {}
+        for name, path in self.paths.items():
+            for root, _ in get_watched_dirs(path):
+                try:
+                    entries = os.listdir(root)
+                except OSError:
+                    continue
+                for entry in entries:
+                    if is_watched_file(entry):
+                        filename = os.path.join(root, entry)
+                        stamps[(name, os.path.relpath(filename, path))] = \
+                            get_stamp(filename)
+        return stamps
+
+    def _poll(self, timeout):
+        time.sleep(timeout)
+        stamps = self.get_stamps()
+        changes = [key for key in set(stamps) | set(self.stamps)
+                   if stamps.get(key) != self.stamps.get(key)]
+        self.stamps = stamps
+        return changes
+
+    def _read(self, timeout):
+        if self.inotify:
+            return self.inotify.read_events(timeout)
+        return self._poll(timeout)
+
+    def wait(self):
+        # blocks until some files changed, returns
+        # component -> set of changed files relative to its sources
+        changes = {}
+        timeout = None if self.inotify else self.poll_interval
+        while not changes:
+            for name, filename in self._read(timeout):
+                changes.setdefault(name, set()).add(filename)
+        while True:
+            events = self._read(self.debounce)
+            if not events:
+                return changes
+            for name, filename in events:
+                changes.setdefault(name, set()).add(filename)
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
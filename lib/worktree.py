@@ -0,0 +1,106 @@
+import os
+import time
+import shutil
+import threading
+import subprocess
+
+from lib import trace
+from lib.common import get_commit
+
+
+class QubesWorktreeException(Exception):
+    pass
+
+
+# Detached git worktrees, one per component and branch, living outside of
+# qubes-src so that the developer checkout is never touched. Worktrees are
+# reused across runs and pruned when unused for more than max_age seconds.
+class QubesWorktreePool:
+    def __init__(self, path, max_age=30 * 24 * 3600):
+        self.path = os.path.abspath(path)
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.repo_locks = {}
+
+    def _get_repo_lock(self, orig_src):
+        # git does not like concurrent worktree administration in one repo
+        with self.lock:
+            if orig_src not in self.repo_locks:
+                self.repo_locks[orig_src] = threading.Lock()
+            return self.repo_locks[orig_src]
+
+    @staticmethod
+    def _git(cwd, *args):
+        with trace.span("git %s" % args[0], "subprocess"):
+            output = subprocess.check_output(
+                ["git"] + list(args), cwd=cwd, text=True,
+                stderr=subprocess.DEVNULL)
+        return output.rstrip('\n')
+
+    def get_worktree_path(self, orig_src, branch):
+        # keep the component name as basename: Makefile.builder evaluation
+        # relies on it
+        return os.path.join(
+            self.path, branch.replace('/', '_'), os.path.basename(orig_src))
+
+    def _get_head(self, worktree):
+        if not os.path.exists(os.path.join(worktree, '.git')):
+            return
+        try:
+            return self._git(worktree, "rev-parse", "HEAD")
+        except subprocess.CalledProcessError:
+            return
+
+    def acquire(self, orig_src, branch):
+        worktree = self.get_worktree_path(orig_src, branch)
+        with self._get_repo_lock(orig_src):
+            commit = get_commit(orig_src, branch)
+            if not commit:
+                raise QubesWorktreeException(
+                    "Cannot find branch '%s' in %s" % (branch, orig_src))
+            head = self._get_head(worktree)
+            try:
+                if not head:
+                    # missing or broken worktree (e.g. main repository has
+                    # been cloned again)
+                    if os.path.exists(worktree):
+                        shutil.rmtree(worktree)
+                    self._git(orig_src, "worktree", "prune")
+                    os.makedirs(os.path.dirname(worktree), exist_ok=True)
+                    self._git(orig_src, "worktree", "add", "-q", "--detach",
+                              "-f", worktree, commit)
+                elif head != commit:
+                    self._git(worktree, "checkout", "-q", "-f", "--detach",
+                              commit)
+            except subprocess.CalledProcessError as e:
+                raise QubesWorktreeException(
+                    "Cannot prepare worktree for %s (%s): %s" % (
+                        orig_src, branch, str(e)))
+            # mtime of the worktree tracks its last use for pruning
+            os.utime(worktree)
+        return worktree, commit
+
+    def _remove(self, worktree):
+        try:
+            common_dir = os.path.join(
+                worktree, self._git(worktree, "rev-parse", "--git-common-dir"))
+            self._git(os.path.dirname(os.path.abspath(common_dir)),
+                      "worktree", "remove", "--force", worktree)
+        except subprocess.CalledProcessError:
+            # main repository is gone or worktree is broken
+            shutil.rmtree(worktree, ignore_errors=True)
+
+    def prune(self):
+        if not os.path.exists(self.path):
+            return
+        now = time.time()
+        for branch_dir in os.scandir(self.path):
+            if not branch_dir.is_dir():
+                continue
+            for worktree in os.scandir(branch_dir.path):
+                if not worktree.is_dir():
+                    continue
+                if now - worktree.stat().st_mtime > self.max_age:
+                    self._remove(worktree.path)
+            if not os.listdir(branch_dir.path):
+                os.rmdir(branch_dir.path)